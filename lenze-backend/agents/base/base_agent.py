@@ -1,44 +1,49 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 from tools.google_search import SearchEngine
-import asyncio
+from tools.metrics import LLM_SECONDS, timed, record_usage
 
 __all__ = ["BaseAgent"]
 
 class BaseAgent:
-    def __init__(self, client: OpenAI, model: str, session_id: int, search_engine: SearchEngine):
+    def __init__(self, client: AsyncOpenAI, model: str, session_id: int, search_engine: SearchEngine):
         self.session_id = session_id
         self.search_engine = search_engine
         self.client = client
         self.model = model
         self.search_history = []
     
-    def _get_response(self, messages: dict, max_token: int = 1000):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=max_token,
-            stream=False
-        )
+    async def _get_response(self, messages: dict, max_token: int = 1000):
+        with timed(LLM_SECONDS, stream='false'):
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_token,
+                stream=False
+            )
+        record_usage(self.model, response.usage)
 
         return response.choices[0].message.content
     
-    def _get_response_stream(self, messages: dict, max_token: int = 1000):
-        response_stream = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=max_token,
-            stream=True
-        )
+    async def _get_response_stream(self, messages: dict, max_token: int = 1000):
+        # Each chunk is awaited on the shared async client, so other connections keep being served
+        with timed(LLM_SECONDS, stream='true'):
+            # With include_usage the last chunk carries the token usage and no choices
+            response_stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_token,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
 
-        for chunk in response_stream:
-            content = chunk.choices[0].delta.content
-            if content is not None:
-                yield content
-
-    async def _async_generator_wrapper(self, generator):
-        loop = asyncio.get_event_loop()
-        for item in generator:
-            yield await loop.run_in_executor(None, lambda: item)
+            async for chunk in response_stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    record_usage(self.model, chunk.usage)
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content is not None:
+                    yield content
 
     def _format_event(self, content):
         return f"data: {content}\n\n"
@@ -1,21 +1,129 @@
+import re
+from tools.tokens import token_counter
+
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+
+class PromptTemplate:
+    """
+    Prompt template split once into literal text and placeholders, so filling it is a single
+    join per message instead of one `str.replace` per placeholder.
+    """
+    def __init__(self, messages):
+        self.messages = []
+        for part in messages:
+            pieces = PLACEHOLDER.split(part["content"])
+            # Odd positions hold placeholder names
+            self.messages.append((part["role"], pieces))
+
+    def fill(self, values):
+        """
+        :param values: Dictionary of placeholder names and values. Placeholders without a value are left as they are.
+
+        :return: List of message dictionaries.
+        """
+        filled_template = []
+        for role, pieces in self.messages:
+            content = []
+            for i, piece in enumerate(pieces):
+                if i % 2 == 0:
+                    content.append(piece)
+                elif piece in values:
+                    content.append(str(values[piece]))
+                else:
+                    content.append(f'{{{piece}}}')
+            filled_template.append({"role": role, "content": ''.join(content)})
+        return filled_template
+
+
 def complete_template(template, values):
     """
     Fill placeholders in the template with corresponding values from the dictionary to complete prompt.
 
-    :param template: List of dictionaries representing the prompt template.
+    Compiles the template on every call, templates used repeatedly should be a PromptTemplate.
+
+    :param template: List of dictionaries representing the prompt template, or a PromptTemplate.
     :param values: Dictionary containing placeholder names and their corresponding values.
 
     :return: List of dictionaries with placeholders filled.
     """
-    filled_template = []
+    if not isinstance(template, PromptTemplate):
+        template = PromptTemplate(template)
+    return template.fill(values)
+
+
+def pack_sources(sources, budget, min_tokens=50):
+    """
+    Fit source texts into a token allowance.
 
-    for part in template:
-        filled_content = part["content"]
-        for placeholder, value in values.items():
-            filled_content = filled_content.replace(f'{{{placeholder}}}', str(value))
-        filled_template.append({"role": part["role"], "content": filled_content})
+    Sources are expected most relevant first. When they do not fit whole, every source gets an
+    equal share of the allowance, shares left over by short sources going to the longer ones,
+    and longer texts are cut to their share. Sources whose share would be under `min_tokens`
+    are dropped, least relevant first.
 
-    return filled_template
+    :param sources: List of dictionaries with a 'text' key.
+    :param budget: Token allowance for all source texts together.
+
+    :return: List of copies of the kept sources with their texts cut to fit.
+    """
+    sizes = [token_counter.count(source['text']) for source in sources]
+    count = len(sources)
+    shares = _fair_shares(sizes, budget)
+    while count > 1 and any(share < min(size, min_tokens) for share, size in zip(shares, sizes)):
+        count -= 1
+        shares = _fair_shares(sizes[:count], budget)
+    packed = []
+    for source, size, share in zip(sources[:count], sizes, shares):
+        text = source['text'] if size <= share else token_counter.truncate(source['text'], share)
+        packed.append({**source, 'text': text})
+    return packed
+
+
+def _fair_shares(sizes, budget):
+    """
+    Max-min fair split of `budget` over items wanting `sizes`, the remainder going to the first items.
+    """
+    shares = [0] * len(sizes)
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    remaining = budget
+    while pending:
+        share = remaining // len(pending)
+        smallest = pending[0]
+        if sizes[smallest] <= share:
+            shares[smallest] = sizes[smallest]
+            remaining -= sizes[smallest]
+            pending.pop(0)
+            continue
+        extra = remaining - share * len(pending)
+        for i in sorted(pending):
+            shares[i] = share + (1 if extra > 0 else 0)
+            extra -= 1
+        break
+    return shares
+
+
+def fit_history(history, budget, response_tokens=150):
+    """
+    Fit search history into a token allowance.
+
+    Each response is cut to `response_tokens`, and the oldest entries are dropped until the
+    rest fits; queries are kept whole.
+
+    :param history: List of dictionaries with 'query' and 'response', oldest first.
+
+    :return: The kept entries, oldest first.
+    """
+    kept = []
+    used = 0
+    for entry in reversed(history):
+        response = token_counter.truncate(entry['response'] or '', response_tokens)
+        cost = token_counter.count(entry['query']) + token_counter.count(response)
+        if used + cost > budget:
+            break
+        kept.append({'query': entry['query'], 'response': response})
+        used += cost
+    kept.reverse()
+    return kept
 
 ANALYZE_PROMPT = [
     {
@@ -164,12 +272,12 @@ INTERACTION_PROPMT = [
     {
         "role": "system",
         "content": """
-You are an intelligent assistant that helps suggesting related queries based on the most recent query-response pair. 
+You are an intelligent assistant that helps suggesting related queries based on the most recent query and the sources found for it. 
 
 Follow these guidelines:
 
 1. Avoid repeating or paraphrasing the last query.
-2. Draw on the response content and context to inspire relevant queries.
+2. Draw on the source content and context to inspire relevant queries.
 3. Ensure the new queries are diverse, covering different aspects or follow-ups.
 4. Use the entire search history to provide meaningful, connected queries.
 5. Introduce fresh perspectives or areas of inquiry, avoiding redundancy.
@@ -177,20 +285,20 @@ Follow these guidelines:
 7. Ensure the response is generated quickly.
 
 Format of output:
-The response should be a list of related queries strictly in the form of:
+The response should be a JSON array of strings, strictly in the form of:
 ["Query 1", "Query2", "Query3"]
+Use double quotes around every query, apostrophes inside a query need no escaping. Output only the array, without code fences or any other text.
 Do not include question mark at the end. 
-It is import to make sure that ANY single quotes in sentences is escaped using a backslash (\'). Do not use U+2019 character as it is banned.
 """ },
     {
         "role": "user",
         "content": """
 Last query:
 {query}
-Last response:
-{response}
+Sources found for it:
+{sources}
 
-Please provide 5 related queries inspired by the latest pair of query and response, utilizing the entire chat history for context.
+Please provide 5 related queries inspired by the latest query and its sources, utilizing the entire chat history for context.
 Each query should be no more than 15 words.
 """}]
 
@@ -252,4 +360,10 @@ Query:
 {query}
 """
     }
-]
\ No newline at end of file
+]
+
+ANALYZE_TEMPLATE = PromptTemplate(ANALYZE_PROMPT)
+ANSWER_TEMPLATE = PromptTemplate(ANSWER_PROMPT)
+INTERACTION_TEMPLATE = PromptTemplate(INTERACTION_PROPMT)
+IMAGE_SEARCH_TEMPLATE = PromptTemplate(IMAGE_SEARCH_PROMPT)
+VIDEO_SEARCH_TEMPLATE = PromptTemplate(VIDEO_SEARCH_PROMPT)
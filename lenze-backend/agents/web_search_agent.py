@@ -1,86 +1,256 @@
 from tools.source_manager import Sources
 from tools.google_search import SearchEngine
-from tools.text_extraction import process_urls_async
-from openai import OpenAI
+from tools.text_extraction import Scraper, scraper_session, BLOCKED_CONTENT
+from tools.chunking import chunk_sources
+from tools.dedup import DuplicateFilter
+from tools.metrics import span, record_stage
+from openai import AsyncOpenAI
 from datetime import date
-from .base.prompts import complete_template, ANALYZE_PROMPT, ANSWER_PROMPT, INTERACTION_PROPMT
+from .base.prompts import ANALYZE_TEMPLATE, ANSWER_TEMPLATE, INTERACTION_TEMPLATE, pack_sources, fit_history
 from .base.base_agent import BaseAgent
 from typing import AsyncGenerator
 import numpy as np
+import asyncio
 import json
 import ast
 import time
+import re
 
 __all__ = ["WebSearchAgent"]
 
+# Words that point back at earlier turns, so the query cannot be searched as typed
+CONTEXT_REFERENCES = {'it', 'its', 'this', 'that', 'these', 'those', 'there', 'here', 'they', 'them', 'their',
+                      'he', 'she', 'him', 'her', 'his', 'former', 'latter', 'above', 'previous', 'same'}
+
+def query_similarity(first: str, second: str) -> float:
+    """
+    Jaccard similarity of the word sets of two queries.
+    """
+    first_words = set(re.findall(r"\w+", first.lower()))
+    second_words = set(re.findall(r"\w+", second.lower()))
+    if not first_words or not second_words:
+        return 0.0
+    return len(first_words & second_words) / len(first_words | second_words)
+
+def parse_related_queries(text: str, limit: int = 5) -> list[str]:
+    """
+    Parse the related-queries completion, tolerating code fences, smart quotes, unescaped
+    apostrophes in quoted lists and plain lists.
+    """
+    text = text.strip().replace('\u2019', "'")
+    match = re.search(r'\[.*\]', text, flags=re.DOTALL)
+    if match:
+        for parser in (json.loads, ast.literal_eval):
+            try:
+                parsed = parser(match.group(0))
+            except (ValueError, SyntaxError):
+                continue
+            if isinstance(parsed, list):
+                queries = [str(query).strip().rstrip('?') for query in parsed if str(query).strip()]
+                return queries[:limit]
+        # A quoted list neither parser accepts, e.g. ['It's great', 'b']: split between the items
+        items = re.split(r'[\'"]\s*,\s*[\'"]', match.group(0)[1:-1])
+        if len(items) > 1:
+            queries = [item.strip().strip('"\'`').strip().rstrip('?') for item in items]
+            return [query for query in queries if query][:limit]
+
+    # Fall back to one query per line, dropping bullets, numbering and quotes
+    queries = []
+    for line in text.splitlines():
+        line = re.sub(r'^\s*(?:[-*\u2022]|\d+[.)])\s*', '', line).strip().strip('[],"\'`').strip().rstrip('?')
+        if line:
+            queries.append(line)
+    return queries[:limit]
+
 class WebSearchAgent(BaseAgent):     
     
-    def __init__(self, client: OpenAI, model: str, session_id: int, search_engine: SearchEngine):
+    def __init__(self, client: AsyncOpenAI, model: str, session_id: int, search_engine: SearchEngine, scraper: Scraper = None, source_tokens: int = 3000, history_tokens: int = 800):
+        """
+        :param source_tokens: Token allowance for the source texts of the answer prompt.
+        :param history_tokens: Token allowance for the search history of the analysis prompt.
+        """
         super().__init__(client, model, session_id, search_engine)
+        self.scraper = scraper
+        self.source_tokens = source_tokens
+        self.history_tokens = history_tokens
         self.source_manager = Sources(session_id)
         self.search_history = []
+        self.timings = {}
+        # Shared by the speculative and refined searches of this query
+        self.duplicates = DuplicateFilter()
+        # Set once the query to search for is known, media searches wait on it
+        self.refined_ready = asyncio.Event()
 
-    def analyze(self):
+    async def analyze(self):
 
         current_date = date.today()
-        values = {'query': self.query, 'current_date': current_date, 'search_history': self.search_history}
-        message = complete_template(ANALYZE_PROMPT, values)
-        self.refined_query = self._get_response(message)
+        values = {'query': self.query, 'current_date': current_date, 'search_history': fit_history(self.search_history, self.history_tokens)}
+        message = ANALYZE_TEMPLATE.fill(values)
+        with span('analyze', self.timings):
+            self.refined_query = await self._get_response(message)
+
+    def needs_analysis(self):
+        """
+        First-turn queries that do not refer back to earlier context are searched as typed.
+        """
+        if self.search_history:
+            return True
+        return bool(set(re.findall(r"\w+", self.query.lower())) & CONTEXT_REFERENCES)
+
+    async def analyze_and_search(self, num: int = 10, keep_threshold: float = 0.5):
+        """
+        Run query analysis and a speculative search for the raw query concurrently.
+
+        If the refined query is close enough to the raw one the speculative results are kept.
+        Otherwise the speculative search is cancelled, whatever it already stored stays in the
+        session index to be ranked alongside the results of a search for the refined query.
+        """
+        start_time = time.perf_counter()
+        if not self.needs_analysis():
+            self.refined_query = self.query
+            self.refined_ready.set()
+            self.timings['speculation'] = 'skipped_analysis'
+            await self.search(num=num)
+        else:
+            speculative = asyncio.create_task(self.search(query=self.query, num=num))
+            try:
+                await self.analyze()
+            except BaseException:
+                # The request fails, stop scraping and storing for it
+                await self._cancel(speculative)
+                raise
+            self.refined_ready.set()
+            if query_similarity(self.query, self.refined_query) >= keep_threshold:
+                self.timings['speculation'] = 'kept'
+                await speculative
+            else:
+                self.timings['speculation'] = 'discarded'
+                await self._cancel(speculative)
+                await self.search(num=num)
+        record_stage('search_ready', time.perf_counter() - start_time, self.timings)
+
+    async def _cancel(self, task):
+        """
+        Cancel a search task and wait for it, its results are no longer needed.
+        """
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f'Discarded search failed: {str(e)}')
   
-    async def search(self, num: int = 10):
+    async def search(self, query: str = None, num: int = 10, deadline: float = 8.0, min_sources: int = 3, early_threshold: float = 0.5):
+        """
+        Search the web and ingest pages as soon as they are scraped.
 
-        print(f'Searching: {self.refined_query}')
-        sources = self.search_engine.web_search(self.refined_query, num=num)
+        Each batch of finished pages is chunked, embedded, stored and scored against the refined
+        query straight away. Scraping stops once `min_sources` distinct sources have a passage with
+        a similarity of at least `early_threshold`, or after `deadline` seconds; pages still loading
+        are cancelled so the answer does not wait on the slowest page.
+
+        :param query: Query to search for, the refined query by default.
+        """
+        query = query or self.refined_query
+        print(f'Searching: {query}')
+        with span('web_search', self.timings):
+            sources = await self.search_engine.web_search(query, num=num)
+        # Mirrors and tracking variants of a URL, or pages a cancelled search already stored, are not fetched
+        sources = self.duplicates.new_sources(sources)
         urls = [source['link'] for source in sources]
-        start_time = time.time()
-        scraped_texts = await process_urls_async(urls)
-        end_time = time.time()
-        print(f'\n**Text extractions took {end_time - start_time:.4f}**')
-        for i in range(len(sources)):
-            sources[i]['text'] = scraped_texts[i]
-        self.source_manager.store_data(sources)
-
-    def find_sources(self):
+        start_time = time.perf_counter()
+
+        # The query embedding is needed to score the first batch, fetch it while pages load
+        query_task = asyncio.create_task(self.source_manager.generate_embeddings([query]))
+        strong_links = set()
+        try:
+            await self._ingest(urls, sources, query_task, deadline, min_sources, early_threshold, strong_links)
+            await query_task
+        finally:
+            if not query_task.done():
+                query_task.cancel()
+
+        record_stage('scrape', time.perf_counter() - start_time, self.timings)
+        print(f'{len(strong_links)} strong sources for: {query}')
+
+    async def _ingest(self, urls, sources, query_task, deadline, min_sources, early_threshold, strong_links):
+        async with scraper_session(self.scraper) as scraper:
+            batches = scraper.iter_urls(urls, deadline=time.monotonic() + deadline)
+            try:
+                async for batch in batches:
+                    fresh = []
+                    for i, result in batch:
+                        sources[i]['text'] = result['text']
+                        sources[i]['tier'] = result['tier']
+                        self.duplicates.add_url(sources[i]['link'])
+                        # Syndicated copies of a page already taken are not embedded again
+                        if result['tier'] == 'error' or not self.duplicates.is_duplicate(result['text']):
+                            fresh.append(sources[i])
+
+                    passages = chunk_sources(fresh, blocked=BLOCKED_CONTENT)
+                    stored = await self.source_manager.store_data(passages)
+                    query_embedding = (await query_task)[0]
+                    for passage in stored:
+                        similarity = np.dot(passage['embedding'], query_embedding) / (np.linalg.norm(passage['embedding']) * np.linalg.norm(query_embedding) or 1.0)
+                        if similarity >= early_threshold:
+                            strong_links.add(passage['link'])
+                    if len(strong_links) >= min_sources:
+                        break
+            finally:
+                await batches.aclose()
+
+    async def find_sources(self):
         
-        most_relevant_sources = self.source_manager.find_most_relevant_sources(self.refined_query)
+        with span('retrieve', self.timings):
+            most_relevant_sources = await self.source_manager.find_most_relevant_sources(self.refined_query)
         return most_relevant_sources
     
-    def answer(self, most_relevant_sources: list[dict]):
+    async def answer(self, most_relevant_sources: list[dict]):
         
-        values = {'sources': most_relevant_sources, 'query': self.refined_query}
-        message = complete_template(ANSWER_PROMPT, values)
+        values = {'sources': pack_sources(most_relevant_sources, self.source_tokens), 'query': self.refined_query}
+        message = ANSWER_TEMPLATE.fill(values)
     
         print('\n=====Answer=====\n')
-        response = self._get_response(message)
+        response = await self._get_response(message)
         self.response = response
 
-        self.search_history.append({'query:': self.query, 'response': self.response})
+        self.search_history.append({'query': self.query, 'response': self.response})
         print(response)
         return self.response
     
     async def answer_stream(self, most_relevant_sources: list[dict]) -> AsyncGenerator[str, None]:
-        values = {'sources': most_relevant_sources, 'query': self.refined_query}
-        message = complete_template(ANSWER_PROMPT, values)
+        values = {'sources': pack_sources(most_relevant_sources, self.source_tokens), 'query': self.refined_query}
+        message = ANSWER_TEMPLATE.fill(values)
 
         self.response = ""
 
         print('\n=====Answer=====\n')
-        async for content in self._async_generator_wrapper(self._get_response_stream(message)):
+        start_time = time.perf_counter()
+        async for content in self._get_response_stream(message):
+            if not self.response:
+                record_stage('answer_ttft', time.perf_counter() - start_time, self.timings)
             self.response += content
             print(content, end='', flush=True)
             formatted_content = content.replace('\n', '\ndata: ')
             yield self._format_event(formatted_content)
 
-        self.search_history.append({'query:': self.query, 'response': self.response})
+        record_stage('answer', time.perf_counter() - start_time, self.timings)
+        self.search_history.append({'query': self.query, 'response': self.response})
         print("Storing conversation")
 
-    def interact(self):
-
-        values = {'query': self.query, 'response': self.response}
-        message = complete_template(INTERACTION_PROPMT, values)
+    async def interact(self, most_relevant_sources: list[dict]):
+        """
+        Suggest related queries from the refined query and its sources, so this can run
+        concurrently with the answer stream.
+        """
+        sources = [{'title': source['title'], 'text': source['text'][:300]} for source in most_relevant_sources]
+        values = {'query': self.refined_query, 'sources': sources}
+        message = INTERACTION_TEMPLATE.fill(values)
 
+        with span('interact', self.timings):
+            related_queries = await self._get_response(message)
         print('\n\n=====Related=====\n')
-        related_queries = self._get_response(message)
-        related = ast.literal_eval(related_queries)
+        related = parse_related_queries(related_queries)
         print(related)
         return related
\ No newline at end of file
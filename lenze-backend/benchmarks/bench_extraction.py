@@ -0,0 +1,86 @@
+"""
+Compare the BeautifulSoup extractor with the lxml extraction engine on saved HTML pages.
+
+For every fixture in benchmarks/fixtures/html the script reports whether both extractors give the
+same text, and the line-level similarity when they do not. It then measures pages/sec for the
+BeautifulSoup extractor, the lxml engine inline, and the lxml engine through the process pool.
+
+Run from lenze-backend:
+
+    python -m benchmarks.bench_extraction --rounds 20
+"""
+import argparse
+import asyncio
+import difflib
+import os
+import time
+from tools.text_extraction import MAX_DOCUMENT_CHARS, clean_text, extract_main_content
+from tools.html_extraction import ExtractionPool, extract_text
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'html')
+
+
+def baseline(html):
+    return clean_text(extract_main_content(html, max_content=MAX_DOCUMENT_CHARS))
+
+
+def load_fixtures():
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+                pages[name] = f.read()
+    return pages
+
+
+def parity(pages):
+    print(f'{"fixture":<26} {"KB":>6} {"old chars":>10} {"new chars":>10} {"similarity":>10}')
+    ratios = []
+    for name, html in pages.items():
+        old, new = baseline(html), extract_text(html, MAX_DOCUMENT_CHARS)
+        ratio = 1.0 if old == new else difflib.SequenceMatcher(None, old.splitlines(), new.splitlines()).ratio()
+        ratios.append(ratio)
+        print(f'{name:<26} {len(html) / 1024:>6.1f} {len(old):>10} {len(new):>10} {ratio:>10.3f}')
+    exact = sum(ratio == 1.0 for ratio in ratios)
+    print(f'identical output on {exact}/{len(ratios)} pages, mean line similarity {sum(ratios) / len(ratios):.3f}\n')
+
+
+def throughput(extract, pages, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for html in pages.values():
+            extract(html)
+    return rounds * len(pages) / (time.perf_counter() - start)
+
+
+async def pool_throughput(pages, rounds, workers):
+    pool = ExtractionPool(workers)
+    await pool.start()
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(pool.extract(html, MAX_DOCUMENT_CHARS) for _ in range(rounds) for html in pages.values()))
+        return rounds * len(pages) / (time.perf_counter() - start)
+    finally:
+        await pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the fixture corpus')
+    parser.add_argument('--workers', type=int, default=None, help='extraction pool size')
+    args = parser.parse_args()
+
+    pages = load_fixtures()
+    parity(pages)
+
+    old = throughput(baseline, pages, args.rounds)
+    new = throughput(lambda html: extract_text(html, MAX_DOCUMENT_CHARS), pages, args.rounds)
+    pooled = asyncio.run(pool_throughput(pages, args.rounds, args.workers))
+    print(f'{"extractor":<22} {"pages/s":>9}')
+    print(f'{"beautifulsoup":<22} {old:>9.0f}')
+    print(f'{"lxml inline":<22} {new:>9.0f}  ({new / old:.1f}x)')
+    print(f'{"lxml process pool":<22} {pooled:>9.0f}  ({pooled / old:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+Offline end-to-end benchmark of the /web-search-stream pipeline.
+
+Everything the pipeline talks to is replaced by local stand-ins, run in a separate process:
+
+- a stub OpenAI server for chat completions (streamed and not) and embeddings, reached through
+  OPENAI_BASE_URL, with configurable latencies. Embeddings hash words into buckets, so related
+  texts get similar vectors and retrieval has something to rank;
+- a fake Custom Search endpoint returning links to the fixture server;
+- a fixture server serving the saved pages in benchmarks/fixtures/html and the PDFs in
+  benchmarks/fixtures/pdf.
+
+The app itself is served by uvicorn in this process with its real lifespan, in a temporary
+working directory so its databases start empty. N sessions run concurrently, each sending a few
+queries in turn (so follow-up queries go through query analysis). The report gives per-stage
+latency percentiles from the stream's timings, client-side time to sources, first token and
+completion, throughput, peak memory, and the token, byte and page counters from /metrics.
+
+Run from lenze-backend:
+
+    python -m benchmarks.bench_pipeline --sessions 8 --turns 3
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import quote
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(BACKEND_DIR, 'benchmarks', 'fixtures')
+WORD = re.compile(r'\w+')
+
+TOPICS = [
+    'python asyncio event loop scheduler',
+    'retrieval augmented generation evaluation',
+    'energy market growth report',
+    'vector index embedding search latency',
+    'browser page render script layout',
+    'climate policy research analysis',
+]
+# /metrics counters shown in the report
+COUNTERS = ('lenze_tokens_total', 'lenze_fetched_bytes_total', 'lenze_pages_total', 'lenze_extracted_chars_total',
+            'lenze_duplicate_sources_total', 'lenze_retrievals_total')
+FOLLOW_UPS = ['how does it compare to threads', 'what are the main results there', 'who wrote about this']
+
+
+def fixture_documents():
+    documents = []
+    for kind in ('html', 'pdf'):
+        directory = os.path.join(FIXTURES, kind)
+        for name in sorted(os.listdir(directory)):
+            documents.append((kind, name))
+    return documents
+
+
+def hashed_embedding(text, dim):
+    """
+    Bag-of-words embedding with hashed buckets: deterministic, and texts sharing words are similar.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD.findall(text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dim] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def stub_app(options, fixtures_port):
+    """
+    aiohttp application with the OpenAI, Custom Search and fixture routes.
+    """
+    from aiohttp import web
+
+    documents = fixture_documents()
+    counter = {'search': 0}
+
+    async def embeddings(request):
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        await asyncio.sleep(options['embed_latency'])
+        data = [{'object': 'embedding', 'index': i, 'embedding': hashed_embedding(text, options['dim'])} for i, text in enumerate(inputs)]
+        tokens = sum(len(WORD.findall(text)) for text in inputs)
+        return web.json_response({'object': 'list', 'data': data, 'model': body['model'],
+                                  'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+
+    def usage(messages, text):
+        # Words stand in for tokens
+        prompt_tokens = sum(len(WORD.findall(message['content'])) for message in messages)
+        completion_tokens = len(WORD.findall(text))
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+    def completion_text(messages):
+        system, user = messages[0]['content'], messages[-1]['content']
+        if 'related queries' in system:
+            return json.dumps([f'{topic} overview' for topic in TOPICS[:3]])
+        if 'refining user queries' in system:
+            match = re.search(r'\*\*Query:\*\*\s*(.*?)\s*\*\*The current date', user, flags=re.DOTALL)
+            return f"{match.group(1) if match else 'query'} {TOPICS[0]}"
+        return ' '.join(['The', 'sources', 'describe'] + WORD.findall(user)[:options['tokens']])
+
+    async def chat(request):
+        body = await request.json()
+        text = completion_text(body['messages'])
+        created = int(time.time())
+        if not body.get('stream'):
+            await asyncio.sleep(options['llm_latency'])
+            return web.json_response({
+                'id': 'stub', 'object': 'chat.completion', 'created': created, 'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text}}],
+                'usage': usage(body['messages'], text)
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await asyncio.sleep(options['ttft'])
+        for token in text.split(' ')[:options['tokens']]:
+            chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': created, 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': {'content': token + ' '}, 'finish_reason': None}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            await asyncio.sleep(options['token_interval'])
+        if body.get('stream_options', {}).get('include_usage'):
+            chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': created, 'model': body['model'],
+                     'choices': [], 'usage': usage(body['messages'], text)}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def custom_search(request):
+        query = request.query['q']
+        start = int(request.query.get('start', 1))
+        count = int(request.query.get('num', 10))
+        counter['search'] += 1
+        await asyncio.sleep(options['search_latency'])
+        items = []
+        for i in range(start - 1, start - 1 + count):
+            kind, name = documents[i % len(documents)]
+            # A nonce per search keeps pages out of the content cache unless caching is measured
+            nonce = 0 if options['warm_cache'] else counter['search']
+            link = f'http://127.0.0.1:{fixtures_port}/{kind}/{name}?q={quote(query)}&n={nonce}'
+            items.append({'title': f'{name} ({i})', 'link': link})
+        return web.json_response({'items': items})
+
+    async def fixture(request):
+        kind, name = request.match_info['kind'], request.match_info['name']
+        path = os.path.join(FIXTURES, kind, os.path.basename(name))
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        await asyncio.sleep(options['page_latency'])
+        with open(path, 'rb') as f:
+            body = f.read()
+        return web.Response(body=body, content_type='application/pdf' if kind == 'pdf' else 'text/html', charset=None if kind == 'pdf' else 'utf-8')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/v1/embeddings', embeddings)
+    app.router.add_post('/v1/chat/completions', chat)
+    app.router.add_get('/customsearch/v1', custom_search)
+    app.router.add_get('/{kind}/{name}', fixture)
+    return app
+
+
+def serve_stubs(options, port, ready):
+    """
+    Child process entry point: serve the stand-ins until killed.
+    """
+    from aiohttp import web
+
+    async def main():
+        runner = web.AppRunner(stub_app(options, port), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def parse_stream(text):
+    """
+    Split an SSE body into (event, data) pairs.
+    """
+    events = []
+    for block in text.split('\n\n'):
+        event, data = 'message', []
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: '):
+                data.append(line[6:])
+        if data:
+            events.append((event, '\n'.join(data)))
+    return events
+
+
+async def run_session(client, index, turns, stages, client_timings):
+    response = await client.post('/start-session')
+    session_id = response.json()['session_id']
+    topic = TOPICS[index % len(TOPICS)]
+    for turn in range(turns):
+        query = topic if turn == 0 else FOLLOW_UPS[(turn - 1) % len(FOLLOW_UPS)]
+        start = time.perf_counter()
+        first_sources = first_token = None
+        body = []
+        async with client.stream('POST', f'/web-search-stream/{session_id}', params={'query': f'{query} {index}'}) as stream:
+            async for chunk in stream.aiter_text():
+                now = time.perf_counter() - start
+                if first_sources is None and 'event: source' in chunk:
+                    first_sources = now
+                elif first_sources is not None and first_token is None and chunk.startswith('data: '):
+                    first_token = now
+                body.append(chunk)
+        total = time.perf_counter() - start
+
+        for event, data in parse_stream(''.join(body)):
+            if event == 'finaljson':
+                for stage, value in json.loads(data)['timings'].items():
+                    if isinstance(value, (int, float)):
+                        stages.setdefault(stage, []).append(value)
+        client_timings.setdefault('time_to_sources', []).append(first_sources or total)
+        client_timings.setdefault('time_to_first_token', []).append(first_token or total)
+        client_timings.setdefault('total', []).append(total)
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return np.percentile(values, 50), np.percentile(values, 90), np.percentile(values, 99), values.max()
+
+
+def report(title, samples):
+    print(f'\n{title}')
+    print(f'{"stage":<22} {"n":>4} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for stage, values in samples.items():
+        p50, p90, p99, worst = percentiles(values)
+        print(f'{stage:<22} {len(values):>4} {p50:>9.1f} {p90:>9.1f} {p99:>9.1f} {worst:>9.1f}')
+
+
+async def run_benchmark(args):
+    import httpx
+    import uvicorn
+
+    # Served over a socket so streamed responses reach the client as they are written
+    config = uvicorn.Config('main:app', host='127.0.0.1', port=args.port + 1, log_level='warning', lifespan='on')
+    server = uvicorn.Server(config)
+    serving = asyncio.create_task(server.serve())
+    try:
+        while not server.started:
+            if serving.done():
+                raise RuntimeError('The backend failed to start')
+            await asyncio.sleep(0.05)
+        import main
+        main.search_engine.custom_search_url = f'http://127.0.0.1:{args.port}/customsearch/v1'
+
+        stages, client_timings = {}, {}
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{args.port + 1}', timeout=120) as client:
+            if args.warmup:
+                await run_session(client, 0, 1, {}, {})
+            start = time.perf_counter()
+            await asyncio.gather(*(run_session(client, i, args.turns, stages, client_timings) for i in range(args.sessions)))
+            wall = time.perf_counter() - start
+            counters = (await client.get('/metrics')).text
+        return stages, client_timings, wall, counters
+    finally:
+        server.should_exit = True
+        await serving
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=8, help='concurrent sessions')
+    parser.add_argument('--turns', type=int, default=3, help='queries per session, sent one after another')
+    parser.add_argument('--port', type=int, default=8791, help='port of the stand-in server, the app is served on the next one')
+    parser.add_argument('--dim', type=int, default=1536, help='embedding size')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='seconds for a non-streamed completion')
+    parser.add_argument('--ttft', type=float, default=0.3, help='seconds to the first streamed token')
+    parser.add_argument('--tokens', type=int, default=80, help='streamed answer tokens')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='seconds between streamed tokens')
+    parser.add_argument('--embed-latency', type=float, default=0.05)
+    parser.add_argument('--search-latency', type=float, default=0.1)
+    parser.add_argument('--page-latency', type=float, default=0.05)
+    parser.add_argument('--warm-cache', action='store_true', help='let repeated pages hit the content cache')
+    parser.add_argument('--warmup', action='store_true', help='run one untimed query first')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak Python heap (slower)')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own output")
+    args = parser.parse_args()
+
+    options = {
+        'dim': args.dim, 'llm_latency': args.llm_latency, 'ttft': args.ttft, 'tokens': args.tokens,
+        'token_interval': args.token_interval, 'embed_latency': args.embed_latency,
+        'search_latency': args.search_latency, 'page_latency': args.page_latency, 'warm_cache': args.warm_cache
+    }
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    stubs = context.Process(target=serve_stubs, args=(options, args.port, ready), daemon=True)
+    stubs.start()
+    if not ready.wait(30):
+        stubs.kill()
+        sys.exit('Stand-in server did not start')
+
+    workdir = tempfile.TemporaryDirectory()
+    try:
+        # The app is imported here, configured for the stand-ins and with its databases in a scratch directory
+        os.environ.update({
+            'OPENAI_API_KEY': 'bench', 'OPENAI_BASE_URL': f'http://127.0.0.1:{args.port}/v1',
+            'GOOGLE_API_KEY': 'bench', 'CSE_ID': 'bench', 'WARM_BROWSERS': '0'
+        })
+        sys.path.insert(0, BACKEND_DIR)
+        os.chdir(workdir.name)
+        if args.tracemalloc:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w')):
+            stages, client_timings, wall, counters = asyncio.run(run_benchmark(args))
+        heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    finally:
+        os.chdir(BACKEND_DIR)
+        stubs.kill()
+        workdir.cleanup()
+
+    queries = len(client_timings.get('total', []))
+    print(f'{args.sessions} concurrent sessions x {args.turns} queries, {len(fixture_documents())} fixture documents')
+    report('Pipeline stages (server timings)', stages)
+    report('Client side', client_timings)
+    print(f'\nthroughput              {queries / wall:.2f} queries/s ({queries} queries in {wall:.2f}s)')
+    print(f'peak RSS                {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+    if heap_peak is not None:
+        print(f'peak Python heap        {heap_peak / 1024 / 1024:.0f} MB')
+    print('\nCounters (from /metrics)')
+    for line in counters.splitlines():
+        if line.startswith(COUNTERS):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
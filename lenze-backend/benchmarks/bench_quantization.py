@@ -0,0 +1,93 @@
+"""
+Compare float32 and int8 embedding storage: recall, score error, size and search speed.
+
+Each format is loaded into a VectorIndex and searched with the same queries. Recall@k is the
+share of the exact float32 top-k found by the compact index; score error is the mean absolute
+difference of the similarities it reports. Bytes per row are those of the BLOB written to the
+sources table and the embeddings cache, and of the in-memory index.
+
+Vectors are synthetic by default: clustered like text embeddings, with queries drawn near
+stored vectors. Saved embeddings can be used instead, e.g. an index saved by the app:
+
+    python -m benchmarks.bench_quantization --rows 20000
+    python -m benchmarks.bench_quantization --vectors data/indexes/session_1.vectors.npy
+
+Run from lenze-backend.
+"""
+import argparse
+import time
+import numpy as np
+from tools.quantization import DTYPES, encode
+from tools.vector_index import VectorIndex
+
+
+def synthetic(rng, rows, dim, clusters=200):
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    members = rng.integers(0, clusters, rows)
+    vectors = centers[members] + 0.8 * rng.standard_normal((rows, dim)).astype(np.float32)
+    return vectors
+
+
+def make_queries(rng, vectors, count):
+    # Perturbed copies of stored vectors, so every query has close neighbours
+    picks = vectors[rng.integers(0, len(vectors), count)]
+    norms = np.linalg.norm(picks, axis=1, keepdims=True)
+    return picks + 0.5 * norms / np.sqrt(vectors.shape[1]) * rng.standard_normal(picks.shape).astype(np.float32)
+
+
+def run(vectors, queries, dtype, top_k, exact):
+    index = VectorIndex(dtype=dtype)
+    index.add(np.arange(1, len(vectors) + 1), vectors)
+
+    start = time.perf_counter()
+    results = [index.search(query, top_k=top_k) for query in queries]
+    search_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+    recall, errors = [], []
+    for hits, truth in zip(results, exact):
+        truth_ids = {row_id for row_id, _ in truth}
+        recall.append(len(truth_ids & {row_id for row_id, _ in hits}) / len(truth_ids))
+        true_scores = dict(truth)
+        errors.extend(abs(score - true_scores[row_id]) for row_id, score in hits if row_id in true_scores)
+    return {
+        'recall': float(np.mean(recall)),
+        'error': float(np.mean(errors)) if errors else 0.0,
+        'blob_bytes': len(encode(vectors[0], dtype)),
+        'index_bytes': index.nbytes() / len(vectors),
+        'search_ms': search_ms
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='synthetic vectors stored')
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--vectors', help='.npy file of embeddings to use instead of synthetic ones')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        vectors = synthetic(rng, args.rows, args.dim)
+    queries = make_queries(rng, vectors, args.queries)
+
+    reference = VectorIndex()
+    reference.add(np.arange(1, len(vectors) + 1), vectors)
+    exact = [reference.search(query, top_k=args.top_k) for query in queries]
+
+    print(f'{len(vectors)} vectors of dim {vectors.shape[1]}, {len(queries)} queries, recall@{args.top_k} against float32')
+    print(f'{"dtype":<8} {"recall":>7} {"score err":>10} {"blob B/row":>11} {"index B/row":>12} {"ms/query":>9}')
+    baseline = None
+    for dtype in DTYPES:
+        result = run(vectors, queries, dtype, args.top_k, exact)
+        baseline = baseline or result
+        print(f'{dtype:<8} {result["recall"]:>7.4f} {result["error"]:>10.5f} {result["blob_bytes"]:>11} '
+              f'{result["index_bytes"]:>12.0f} {result["search_ms"]:>9.2f}  '
+              f'({baseline["index_bytes"] / result["index_bytes"]:.1f}x smaller)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Compare the per-session table layout with the single-table SourceStore.
+
+The legacy layout is reproduced as it was: one `sources_{session_id}` table per session, an index
+on the embedding BLOB and a new connection for every call. Both layouts store the same passages
+and are then read back session by session.
+
+Run from lenze-backend:
+
+    python -m benchmarks.bench_source_store --sessions 500 --rows 40
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+from tools.source_store import SourceStore
+
+
+class LegacyStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def create(self, session_id):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS sources_{session_id} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT,
+                link TEXT,
+                text TEXT,
+                embedding BLOB,
+                chunk_index INTEGER DEFAULT 0
+            )
+        ''')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_embedding ON sources_{session_id}(embedding);')
+        conn.commit()
+        conn.close()
+
+    def insert(self, session_id, rows):
+        self.create(session_id)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        row_ids = []
+        for title, link, text, embedding, chunk_index in rows:
+            cursor.execute(
+                f'INSERT INTO sources_{session_id} (title, link, text, embedding, chunk_index) VALUES (?, ?, ?, ?, ?)',
+                (title, link, text, embedding.tobytes(), chunk_index)
+            )
+            row_ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+        return row_ids
+
+    def load_vectors(self, session_id, after_id=0):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(f'SELECT id, embedding FROM sources_{session_id} WHERE id > ? ORDER BY id', (after_id,)).fetchall()
+        conn.close()
+        return [row[0] for row in rows], np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+
+
+def make_rows(rng, count, dim):
+    text = 'lorem ipsum dolor sit amet ' * 30
+    return [(f'Title {i}', f'https://example.com/{i}', text, rng.standard_normal(dim).astype(np.float32), i % 20) for i in range(count)]
+
+
+def run(store, sessions, rows_per_session, batches, dim):
+    rng = np.random.default_rng(0)
+    batch_rows = [make_rows(rng, rows_per_session // batches, dim) for _ in range(batches)]
+
+    start = time.perf_counter()
+    for session_id in range(1, sessions + 1):
+        for rows in batch_rows:
+            store.insert(session_id, rows)
+    insert_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for session_id in range(1, sessions + 1):
+        store.load_vectors(session_id, 0)
+    read_time = time.perf_counter() - start
+
+    total = sessions * (rows_per_session // batches) * batches
+    return {'rows': total, 'insert_rows_per_s': total / insert_time, 'read_rows_per_s': total / read_time,
+            'db_bytes': sum(os.path.getsize(os.path.join(os.path.dirname(store.db_path), name))
+                            for name in os.listdir(os.path.dirname(store.db_path)))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--rows', type=int, default=40, help='passages per session')
+    parser.add_argument('--batches', type=int, default=4, help='store_data calls per session')
+    parser.add_argument('--dim', type=int, default=1536)
+    args = parser.parse_args()
+
+    results = {}
+    for name in ('legacy', 'store'):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'sources.db')
+            store = LegacyStore(db_path) if name == 'legacy' else SourceStore(db_path)
+            results[name] = run(store, args.sessions, args.rows, args.batches, args.dim)
+            if name == 'store':
+                store.close()
+
+    print(f'{args.sessions} sessions x {args.rows} passages, {args.batches} inserts per session, dim {args.dim}')
+    print(f'{"layout":<8} {"insert rows/s":>14} {"read rows/s":>12} {"db MB":>8}')
+    for name, result in results.items():
+        print(f'{name:<8} {result["insert_rows_per_s"]:>14.0f} {result["read_rows_per_s"]:>12.0f} {result["db_bytes"] / 1e6:>8.1f}')
+    print(f'speedup  {results["store"]["insert_rows_per_s"] / results["legacy"]["insert_rows_per_s"]:>14.1f}x '
+          f'{results["store"]["read_rows_per_s"] / results["legacy"]["read_rows_per_s"]:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
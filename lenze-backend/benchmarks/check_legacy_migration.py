@@ -0,0 +1,114 @@
+"""
+Check that sessions stored by the original per-session layout still answer queries once migrated.
+
+A `sources_{session_id}` table is created as the original Sources class did, including its
+one-float "embeddings", and migrated into the shared table. The session then stores a new page
+and is queried, before and after its old passages are re-embedded, on its own and across
+sessions. Embeddings come from a local word-hashing stub, no API key is needed.
+
+Run from lenze-backend:
+
+    python -m benchmarks.check_legacy_migration
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import tempfile
+import numpy as np
+from tools.persistence import WriteBehindQueue
+from tools.source_manager import Sources, backfill_embeddings
+from tools.source_store import SourceStore
+from tools.vector_index import IndexRegistry
+
+LEGACY_SESSION = 7
+LEGACY_PAGES = [
+    ('Tidal power', 'https://example.org/tidal', 'Tidal power turns the rise and fall of sea levels into electricity with barrages and turbines.'),
+    ('Sourdough', 'https://example.org/sourdough', 'Sourdough bread is leavened by wild yeast and lactic acid bacteria kept alive in a starter.'),
+]
+NEW_PAGE = {'title': 'Glaciers', 'link': 'https://example.org/glaciers', 'text': 'Glaciers flow slowly downhill under their own weight, carving valleys as they move.'}
+
+
+class HashingEmbedder:
+    """
+    Word-hashing embeddings, texts sharing words are similar.
+    """
+    def __init__(self, dim=64):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            vector[hash(word) % self.dim] += 1.0
+        return vector
+
+    def peek(self, text):
+        return None
+
+    async def embed(self, texts):
+        return [self._embed(text) for text in texts]
+
+
+def create_legacy_table(db_path, session_id):
+    # As the original Sources.initialize_sources and store_data wrote it
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS sources_{session_id} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            link TEXT,
+            text TEXT,
+            embedding BLOB
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_embedding ON sources_{session_id}(embedding);')
+    conn.executemany(f'INSERT INTO sources_{session_id} (title, link, text, embedding) VALUES (?, ?, ?, ?)',
+                     [(title, link, text, np.array(0.25, dtype=np.float32).tobytes()) for title, link, text in LEGACY_PAGES])
+    conn.commit()
+    conn.close()
+
+
+async def run(directory):
+    db_path = os.path.join(directory, 'sources.db')
+    create_legacy_table(db_path, LEGACY_SESSION)
+    store = SourceStore(db_path)
+    registry = IndexRegistry(directory=os.path.join(directory, 'indexes'))
+    embedder = HashingEmbedder()
+    writer = WriteBehindQueue()
+
+    assert store.migrate_legacy_tables() == [LEGACY_SESSION], 'legacy table was not migrated'
+    sources = Sources(LEGACY_SESSION, embedder=embedder, registry=registry, store=store, writer=writer)
+
+    # The follow-up query of a migrated session, before its old passages are re-embedded
+    await sources.store_data([NEW_PAGE])
+    found = await sources.find_most_relevant_sources('how do glaciers flow', similarity_threshold=0.1, lexical_candidates=0)
+    assert [source['link'] for source in found] == [NEW_PAGE['link']], f'unexpected sources {found}'
+    await writer.stop()
+    registry.save_all()
+
+    assert await backfill_embeddings(store, embedder, registry) == len(LEGACY_PAGES), 'legacy rows were not re-embedded'
+    sources = Sources(LEGACY_SESSION, embedder=embedder, registry=registry, store=store, writer=writer)
+    assert len(sources.index) == len(LEGACY_PAGES) + 1, 'index was not rebuilt with the re-embedded rows'
+    for across_sessions in (False, True):
+        found = await sources.find_most_relevant_sources('tidal power electricity', similarity_threshold=0.1,
+                                                         lexical_candidates=0, across_sessions=across_sessions)
+        assert found and found[0]['link'] == LEGACY_PAGES[0][1], f'unexpected sources {found}'
+
+    # A stray embedding of another length is skipped rather than breaking the index
+    store.writer.execute('INSERT INTO sources (session_id, title, link, text, embedding) VALUES (?, ?, ?, ?, ?)',
+                         (LEGACY_SESSION, 'Stray', 'https://example.org/stray', 'stray', np.zeros(3, dtype=np.float32).tobytes()))
+    store.writer.commit()
+    ids, vectors = store.load_vectors(LEGACY_SESSION)
+    assert vectors.shape == (len(LEGACY_PAGES) + 1, embedder.dim), f'unexpected vectors {vectors.shape}'
+    await writer.stop()
+    store.close()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(directory))
+    print('Legacy migration check passed')
+
+
+if __name__ == '__main__':
+    main()
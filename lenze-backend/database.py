@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -9,4 +9,23 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 def initialize_session():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    migrate_schema()
+
+def migrate_schema():
+    """
+    Bring databases created before sessions.first_query up to date: add the column, backfill it
+    with one aggregated query and create the indexes `create_all` skips on existing tables.
+    """
+    columns = [column['name'] for column in inspect(engine).get_columns('sessions')]
+    with engine.begin() as conn:
+        # Created first so the backfill below finds each session's first search through it
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_searches_session_id_id ON searches (session_id, id)'))
+        if 'first_query' not in columns:
+            conn.execute(text('ALTER TABLE sessions ADD COLUMN first_query TEXT'))
+            conn.execute(text('''
+                UPDATE sessions SET first_query = (
+                    SELECT query FROM searches WHERE searches.session_id = sessions.id ORDER BY searches.id LIMIT 1
+                )
+            '''))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_sessions_listed ON sessions (id) WHERE first_query IS NOT NULL'))
@@ -1,24 +1,82 @@
 # APIs built with FastAPI
 from fastapi import FastAPI, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.encoders import jsonable_encoder
 from agents.web_search_agent import WebSearchAgent
 from agents.image_search_agent import ImageSearchAgent
 from agents.video_search_agent import VideoSearchAgent
-from tools.source_manager import Sources
+from tools.source_manager import Sources, backfill_embeddings
 from tools.google_search import SearchEngine
+from tools.text_extraction import Scraper
+from tools.http_client import HttpClient
+from tools.content_cache import ContentCache
+from tools.vector_index import index_registry
+from tools.source_store import shared_source_store
+from tools.persistence import write_queue
+from tools.embeddings import shared_embedding_service
+from tools.metrics import metrics, span, record_stage
+from tools.tokens import token_counter
 from sqlalchemy.orm import Session
 from models import SearchHistory, Session as DBSession
 from database import initialize_session, SessionLocal
-from openai import OpenAI
+from openai import AsyncOpenAI
 from typing import Annotated, AsyncGenerator
+from contextlib import asynccontextmanager
 from models import *
 import os
 import time
 import json
+import asyncio
 
-app = FastAPI()
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# One async client for chat and embeddings so HTTP connections are reused
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Search and scraping share one pooled HTTP session
+http_client = HttpClient()
+search_engine = SearchEngine(http_client)
+content_cache = ContentCache()
+scraper = Scraper(http_client=http_client, cache=content_cache)
+
+# State kept by the shared services, read when /metrics is scraped
+metrics.gauge('lenze_write_queue_depth', 'Writes queued or being committed.', lambda: write_queue.depth)
+metrics.gauge('lenze_embedding_cache_hits', 'Embedding cache hits since start.', lambda: shared_embedding_service().hits)
+metrics.gauge('lenze_embedding_cache_misses', 'Embedding cache misses since start.', lambda: shared_embedding_service().misses)
+metrics.gauge('lenze_open_circuits', 'Domains currently skipped by the circuit breaker.', lambda: len(scraper.domain_guard.stats()['open']))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The shared stores open their databases here rather than when their modules are imported
+    source_store = shared_source_store()
+    embedding_service = shared_embedding_service()
+    embedding_service.client = client
+    # Sessions stored in the old per-session tables get new row ids, so their saved indexes are rebuilt
+    for session_id in source_store.migrate_legacy_tables():
+        index_registry.drop(f'session_{session_id}')
+    # Migrated rows have no embeddings yet, they are embedded in the background
+    backfill = asyncio.create_task(backfill_embeddings(source_store, embedding_service, index_registry))
+    # Warm browsers and the pooled HTTP session are shared by every request and closed on shutdown.
+    # WARM_BROWSERS=0 leaves browsers to be launched on first use, e.g. where Chromium is missing
+    await scraper.start(warm_browsers=os.getenv('WARM_BROWSERS', '1') != '0')
+    write_queue.start()
+    # Prompt budgets count tokens, load the encoding before the first request needs it
+    await asyncio.to_thread(token_counter.load)
+    yield
+    backfill.cancel()
+    try:
+        await backfill
+    except asyncio.CancelledError:
+        pass
+    await scraper.stop()
+    # Queued history and source writes are committed before the databases close
+    await write_queue.stop()
+    content_cache.close()
+    embedding_service.close()
+    index_registry.save_all()
+    source_store.close()
+    await client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration
 origins = [
@@ -32,12 +90,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
-search_engine = SearchEngine()
-
 initialize_session()
 
 # Dependency
@@ -62,79 +117,225 @@ def start_session(db: Session = Depends(get_db)):
     return {"session_id": new_session.id, "start_time": new_session.start_time, "sources": new_session.sources}
 
 @app.get("/search-history", response_model=list[SessionInfo])
-def get_search_history(db: Session = Depends(get_db)):
-    sessions = db.query(DBSession).all()
-    session_histories = []
-    for session in sessions:
-        first_query = db.query(SearchHistory).filter(SearchHistory.session_id == session.id).order_by(SearchHistory.timestamp).first()
-        if first_query:
-            session_histories.append({
-                "session_id": session.id,
-                "start_time": jsonable_encoder(session.start_time),
-                "first_query": first_query.query
-            })
-    return JSONResponse(content=session_histories)
+def get_search_history(limit: Annotated[int, Query(ge=1, le=200)] = 50, before: int | None = None, db: Session = Depends(get_db)):
+    """
+    Sessions with at least one search, newest first.
+
+    Pages are keyed on the session id: pass the `X-Next-Cursor` header of a response as `before`
+    to get the next page. The header is absent on the last page.
+    """
+    sessions = db.query(DBSession.id, DBSession.start_time, DBSession.first_query).filter(DBSession.first_query.isnot(None))
+    if before is not None:
+        sessions = sessions.filter(DBSession.id < before)
+    sessions = sessions.order_by(DBSession.id.desc()).limit(limit).all()
+    session_histories = [{
+        "session_id": session.id,
+        "start_time": jsonable_encoder(session.start_time),
+        "first_query": session.first_query
+    } for session in sessions]
+    headers = {"X-Next-Cursor": str(sessions[-1].id)} if len(sessions) == limit else None
+    return JSONResponse(content=session_histories, headers=headers)
 
 @app.get("/conversations/{session_id}", response_model=list[ConversationInfo])
-async def get_conversations(session_id: int, db: Session = Depends(get_db)):
-    conversations = db.query(SearchHistory).filter(SearchHistory.session_id == session_id).all()
-    conversation_histories = []
-    for conversation in conversations:
-        conversation_histories.append({
-            "query": conversation.query,
-            "response": conversation.response
-        })
-    return JSONResponse(content=conversation_histories)
+async def get_conversations(session_id: int, limit: Annotated[int, Query(ge=1, le=500)] = 100, after: int | None = None, db: Session = Depends(get_db)):
+    """
+    Searches of a session, oldest first.
 
-@app.post("/web-search-stream/{session_id}", response_model=WebSearchResponseModel)
-async def web_search_stream(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)], db: Session = Depends(get_db)):
-    agent = WebSearchAgent(client, 'gpt-4o-mini', session_id, search_engine)
+    Pass the `X-Next-Cursor` header of a response as `after` to get the next page.
+    """
+    conversations = db.query(SearchHistory.id, SearchHistory.query, SearchHistory.response).filter(SearchHistory.session_id == session_id)
+    if after is not None:
+        conversations = conversations.filter(SearchHistory.id > after)
+    conversations = conversations.order_by(SearchHistory.id).limit(limit).all()
+    conversation_histories = [{
+        "query": conversation.query,
+        "response": conversation.response
+    } for conversation in conversations]
+    headers = {"X-Next-Cursor": str(conversations[-1].id)} if len(conversations) == limit else None
+    return JSONResponse(content=conversation_histories, headers=headers)
+
+@app.get("/cache-stats")
+def get_cache_stats():
+    return JSONResponse(content=content_cache.stats())
+
+@app.get("/domain-stats")
+def get_domain_stats():
+    return JSONResponse(content=scraper.domain_guard.stats())
+
+@app.get("/persistence-stats")
+def get_persistence_stats():
+    return JSONResponse(content=write_queue.stats())
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Stage latency histograms, fetch, token and byte counters in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def save_search_entries(entries):
+    """
+    Write queued (session_id, query, response) entries in one transaction. Runs in the write
+    queue's worker thread with its own session, the request's session is closed by now.
+    """
+    db = SessionLocal()
+    try:
+        db.add_all([SearchHistory(session_id=session_id, query=query, response=response) for session_id, query, response in entries])
+        first_queries = {}
+        for session_id, query, _ in entries:
+            first_queries.setdefault(session_id, query)
+        for session_id, query in first_queries.items():
+            db.query(DBSession).filter(DBSession.id == session_id, DBSession.first_query.is_(None)).update({DBSession.first_query: query})
+        db.commit()
+    finally:
+        db.close()
+
+def create_web_agent(session_id: int, query: str, db: Session) -> WebSearchAgent:
+    agent = WebSearchAgent(client, 'gpt-4o-mini', session_id, search_engine, scraper)
     agent.query = query
-    start_time = time.time()
+    previous = db.query(SearchHistory).filter(SearchHistory.session_id == session_id).order_by(SearchHistory.id.desc()).limit(5).all()
+    agent.search_history = [{'query': entry.query, 'response': entry.response} for entry in reversed(previous)]
+    return agent
 
-    agent.analyze()
+@app.post("/web-search-stream/{session_id}", response_model=WebSearchResponseModel)
+async def web_search_stream(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)], db: Session = Depends(get_db)):
+    agent = create_web_agent(session_id, query, db)
+    start_time = time.perf_counter()
 
-    search_start = time.time()
-    await agent.search()
-    search_end = time.time()
-    
-    print(f'\n**Search took {search_end-search_start:.4f} seconds**\n')
+    # Analysis runs concurrently with a speculative search for the raw query
+    await agent.analyze_and_search()
 
-    
-    most_relevant_sources = agent.find_sources()
+    most_relevant_sources = await agent.find_sources()
     source_links = json.dumps([{'index': i+1, 'title': source['title'], 'link': source['link']} for i, source in enumerate(most_relevant_sources)])
     source_contents = [{'index': i+1, 'text': source['text']} for i, source in enumerate(most_relevant_sources)]
 
     async def response_generator() -> AsyncGenerator[str, None]:
+        # Related queries only need the refined query and sources, generate them alongside the answer
+        related_task = asyncio.create_task(agent.interact(most_relevant_sources))
         yield f'event: source\ndata: {source_links}\n\n'
-        async for chunk in agent.answer_stream(source_contents):
-            yield chunk
-            
-        related_queries = agent.interact()
-        end_time = time.time()
-        time_taken = f"Response generated in {end_time - start_time:.4f} seconds" 
-        print(f'\n**{time_taken}**\n')
+        try:
+            async for chunk in agent.answer_stream(source_contents):
+                yield chunk
+        except BaseException:
+            related_task.cancel()
+            raise
+
+        with span('related_wait', agent.timings):
+            try:
+                related_queries = await related_task
+            except Exception as e:
+                print(f'Failed to generate related queries: {str(e)}')
+                related_queries = []
+        total = time.perf_counter() - start_time
+        time_taken = f"Response generated in {total:.4f} seconds"
+        record_stage('total', total, agent.timings)
+        print(f'Stage timings: {agent.timings}')
+
+        # Queued so the stream ends without waiting on the database
+        write_queue.submit(save_search_entries, (session_id, query, agent.response))
         
-        final_json = json.dumps({"related": related_queries, "time_taken": time_taken})
+        final_json = json.dumps({"related": related_queries, "time_taken": time_taken, "timings": agent.timings})
+        yield f'event: finaljson\ndata: {final_json}\n\n'
+
+    return StreamingResponse(response_generator(), media_type="text/event-stream")
+
+@app.post("/search-stream/{session_id}")
+async def search_stream(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)], db: Session = Depends(get_db)):
+    """
+    Web answer, images and videos for one query in a single event stream.
+
+    The query is refined once and web, image and video retrieval fan out concurrently. Images
+    and videos are sent as 'images' and 'videos' events as soon as they are ready, interleaved
+    with the web answer, and 'finaljson' always comes last.
+    """
+    agent = create_web_agent(session_id, query, db)
+    start_time = time.perf_counter()
+    events = asyncio.Queue()
+
+    async def web_producer():
+        try:
+            await agent.analyze_and_search()
+        finally:
+            # Never leave the media searches waiting, even if the web search failed
+            agent.refined_ready.set()
+        most_relevant_sources = await agent.find_sources()
+        source_links = json.dumps([{'index': i+1, 'title': source['title'], 'link': source['link']} for i, source in enumerate(most_relevant_sources)])
+        source_contents = [{'index': i+1, 'text': source['text']} for i, source in enumerate(most_relevant_sources)]
+
+        related_task = asyncio.create_task(agent.interact(most_relevant_sources))
+        await events.put(f'event: source\ndata: {source_links}\n\n')
+        try:
+            async for chunk in agent.answer_stream(source_contents):
+                await events.put(chunk)
+        except BaseException:
+            related_task.cancel()
+            raise
+        try:
+            agent.related = await related_task
+        except Exception as e:
+            print(f'Failed to generate related queries: {str(e)}')
+        # Queued so the stream ends without waiting on the database
+        write_queue.submit(save_search_entries, (session_id, query, agent.response))
+
+    async def media_producer(event, search):
+        # Media searches reuse the refined query instead of running their own refinement prompt
+        await agent.refined_ready.wait()
+        with span(event, agent.timings):
+            try:
+                results = await search(getattr(agent, 'refined_query', query))
+            except Exception as e:
+                print(f'{event.capitalize()} search failed: {str(e)}')
+                results = []
+        await events.put(f'event: {event}\ndata: {json.dumps(results)}\n\n')
+
+    async def run(producer):
+        try:
+            await producer
+        except Exception as e:
+            print(f'Search stream failed: {str(e)}')
+        finally:
+            await events.put(None)
+
+    async def response_generator() -> AsyncGenerator[str, None]:
+        agent.related = []
+        producers = [
+            asyncio.create_task(run(web_producer())),
+            asyncio.create_task(run(media_producer('images', search_engine.image_search))),
+            asyncio.create_task(run(media_producer('videos', search_engine.video_search)))
+        ]
+        try:
+            finished = 0
+            while finished < len(producers):
+                event = await events.get()
+                if event is None:
+                    finished += 1
+                else:
+                    yield event
+        finally:
+            for producer in producers:
+                if not producer.done():
+                    producer.cancel()
+
+        total = time.perf_counter() - start_time
+        time_taken = f"Response generated in {total:.4f} seconds"
+        record_stage('total', total, agent.timings)
+        print(f'Stage timings: {agent.timings}')
+
+        final_json = json.dumps({"related": agent.related, "time_taken": time_taken, "timings": agent.timings})
         yield f'event: finaljson\ndata: {final_json}\n\n'
-    
-        search_entry = SearchHistory(session_id=session_id, query=query, response=agent.response)
-        db.add(search_entry)
-        db.commit()
-        db.refresh(search_entry)
 
     return StreamingResponse(response_generator(), media_type="text/event-stream")
 
 @app.post("/video-search/{session_id}")
-def video_search(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)]) -> list[str]:
+async def video_search(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)]) -> list[str]:
     agent = VideoSearchAgent(client, 'gpt-4o-mini', session_id, search_engine)
     agent.query = query
-    video_ids = agent.search()
+    video_ids = await agent.search()
     return JSONResponse(content=video_ids)
 
 @app.post("/image_serch/{session_id}")
-def image_search(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)]) -> list[str]:
+async def image_search(session_id: int, query: Annotated[str, Query(min_length=1, max_length=100)]) -> list[str]:
     agent = ImageSearchAgent(client, 'gpt-4o-mini', session_id, search_engine)
     agent.query = query
-    image_urls = agent.search()
+    image_urls = await agent.search()
     return JSONResponse(content=image_urls)
\ No newline at end of file
@@ -1,7 +1,7 @@
 from pydantic import BaseModel
 import markdown
 import pytz
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 import datetime
 from database import Base
@@ -11,6 +11,11 @@ class Session(Base):
     id = Column(Integer, primary_key=True, index=True)
     start_time = Column(DateTime, default=datetime.datetime.now(pytz.timezone('Europe/London')))
     sources = Column(String, nullable=True)
+    # Copied from the session's first search so listing sessions needs no join
+    first_query = Column(Text, nullable=True)
+
+    # Only sessions with a search are listed, newest first
+    __table_args__ = (Index('ix_sessions_listed', 'id', sqlite_where=first_query.isnot(None)),)
 
 class SearchHistory(Base):
     __tablename__ = "searches"
@@ -22,6 +27,8 @@ class SearchHistory(Base):
     
     session = relationship("Session", back_populates="searches")
 
+    __table_args__ = (Index('ix_searches_session_id_id', 'session_id', 'id'),)
+
 Session.searches = relationship("SearchHistory", order_by=SearchHistory.id, back_populates="session")
 
 def WebSearchResponseModel(BaseModel):
@@ -0,0 +1,161 @@
+import asyncio
+from contextlib import asynccontextmanager
+from playwright.async_api import async_playwright
+
+__all__ = ["BrowserPool"]
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+BROWSER_ARGS = ["--disable-gpu", "--no-sandbox", "--disable-dev-shm-usage"]
+
+
+class _BrowserSlot:
+    """
+    One warm Chromium process with its context and recycled pages.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.browser = None
+        self.context = None
+        self.idle_pages = []
+        self.active = 0
+        self.pages_served = 0
+        self.lock = asyncio.Lock()
+
+    def is_healthy(self):
+        return self.browser is not None and self.browser.is_connected()
+
+
+class BrowserPool:
+    """
+    Pool of long-lived headless Chromium browsers shared across requests.
+
+    The pool is started once in the app lifespan. Each browser keeps a warm context, pages are
+    reset and handed back out between jobs, and a browser is restarted after serving
+    `max_pages_per_browser` pages or when it crashes. At most `size * pages_per_browser` pages
+    are open at any time, which keeps memory bounded under concurrent traffic.
+    """
+    def __init__(self, size=2, pages_per_browser=5, max_pages_per_browser=200, health_check_interval=30):
+        self.size = size
+        self.pages_per_browser = pages_per_browser
+        self.max_pages_per_browser = max_pages_per_browser
+        self.health_check_interval = health_check_interval
+        self.slots = [_BrowserSlot(i) for i in range(size)]
+        self.semaphore = asyncio.Semaphore(size * pages_per_browser)
+        self.playwright = None
+        self.health_task = None
+        self.start_lock = asyncio.Lock()
+        self.restarts = 0
+
+    async def start(self):
+        """
+        Start Playwright and launch every browser in the pool.
+        """
+        async with self.start_lock:
+            if self.playwright is not None:
+                return
+            self.playwright = await async_playwright().start()
+            await asyncio.gather(*(self._launch(slot) for slot in self.slots))
+            self.health_task = asyncio.create_task(self._health_check_loop())
+            print(f'Browser pool started with {self.size} browsers')
+
+    async def stop(self):
+        """
+        Close every browser and stop Playwright.
+        """
+        if self.health_task is not None:
+            self.health_task.cancel()
+            try:
+                await self.health_task
+            except asyncio.CancelledError:
+                pass
+            self.health_task = None
+        await asyncio.gather(*(self._close(slot) for slot in self.slots), return_exceptions=True)
+        if self.playwright is not None:
+            await self.playwright.stop()
+            self.playwright = None
+
+    async def _launch(self, slot):
+        slot.browser = await self.playwright.chromium.launch(headless=True, args=BROWSER_ARGS)
+        slot.context = await slot.browser.new_context(user_agent=USER_AGENT)
+        slot.pages_served = 0
+
+    async def _close(self, slot):
+        slot.idle_pages = []
+        browser, slot.browser, slot.context = slot.browser, None, None
+        if browser is not None:
+            try:
+                await browser.close()
+            except Exception:
+                pass
+
+    async def _restart(self, slot):
+        async with slot.lock:
+            # Another job may have restarted this browser while we waited for the lock
+            if slot.is_healthy() and slot.pages_served < self.max_pages_per_browser:
+                return
+            await self._close(slot)
+            await self._launch(slot)
+            self.restarts += 1
+            print(f'Browser {slot.index} restarted')
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for slot in self.slots:
+                if slot.active == 0 and not slot.is_healthy():
+                    try:
+                        await self._restart(slot)
+                    except Exception as e:
+                        print(f'Failed to restart browser {slot.index}: {str(e)}')
+
+    def _pick_slot(self):
+        # Prefer browsers that are not due for a restart, then the least busy one
+        return min(self.slots, key=lambda slot: (slot.pages_served >= self.max_pages_per_browser, slot.active))
+
+    async def _acquire_page(self, slot):
+        if not slot.is_healthy():
+            await self._restart(slot)
+        while slot.idle_pages:
+            page = slot.idle_pages.pop()
+            if not page.is_closed():
+                return page
+        return await slot.context.new_page()
+
+    async def _release_page(self, slot, page, reusable):
+        slot.active -= 1
+        slot.pages_served += 1
+        if reusable and slot.is_healthy() and slot.pages_served < self.max_pages_per_browser:
+            try:
+                await page.goto('about:blank')
+                slot.idle_pages.append(page)
+                return
+            except Exception:
+                pass
+        try:
+            await page.close()
+        except Exception:
+            pass
+        if slot.active == 0 and (slot.pages_served >= self.max_pages_per_browser or not slot.is_healthy()):
+            await self._restart(slot)
+
+    @asynccontextmanager
+    async def page(self):
+        """
+        Borrow a page from the pool. The page is recycled when the block exits cleanly and
+        closed if the block raised or was cancelled.
+        """
+        await self.start()
+        async with self.semaphore:
+            slot = self._pick_slot()
+            slot.active += 1
+            try:
+                page = await self._acquire_page(slot)
+            except BaseException:
+                slot.active -= 1
+                raise
+            reusable = False
+            try:
+                yield page
+                reusable = True
+            finally:
+                await asyncio.shield(self._release_page(slot, page, reusable))
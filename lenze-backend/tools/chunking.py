@@ -0,0 +1,72 @@
+import re
+
+__all__ = ["split_passages", "chunk_sources"]
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def _split_long(paragraph, chunk_size):
+    """
+    Break a paragraph longer than `chunk_size` on sentence ends, and on words as a last resort.
+    """
+    pieces = []
+    for sentence in SENTENCE_END.split(paragraph):
+        while len(sentence) > chunk_size:
+            cut = sentence.rfind(' ', 0, chunk_size)
+            cut = cut if cut > 0 else chunk_size
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def split_passages(text, chunk_size=800, overlap=100):
+    """
+    Split a document into overlapping passages of roughly `chunk_size` characters.
+
+    Paragraphs (lines of the extracted text) are packed together until the next one would not
+    fit. Each passage starts with the last `overlap` characters of the previous one, cut at a
+    word boundary, so a sentence spanning two passages is still found whole in one of them.
+
+    :return: List of passage strings.
+    """
+    units = []
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        units.extend(_split_long(paragraph, chunk_size) if len(paragraph) > chunk_size else [paragraph])
+
+    passages = []
+    current = ''
+    for unit in units:
+        if current and len(current) + len(unit) + 1 > chunk_size:
+            passages.append(current)
+            tail = current[-overlap:] if overlap else ''
+            space = tail.find(' ')
+            current = tail[space + 1:] if space >= 0 else ''
+        current = f'{current}\n{unit}' if current else unit
+    if current:
+        passages.append(current)
+    return passages
+
+
+def chunk_sources(sources, blocked=(), chunk_size=800, overlap=100, max_passages=20):
+    """
+    Turn scraped sources into passages ready for embedding.
+
+    :param sources: List of dictionaries with 'title', 'link' and 'text' keys.
+    :param blocked: Texts to drop, e.g. bot-wall messages.
+    :param max_passages: Maximum number of passages kept per source.
+
+    :return: List of dictionaries with 'title', 'link', 'text' and 'chunk_index' keys.
+    """
+    passages = []
+    for source in sources:
+        text = source.get('text')
+        if not text or text in blocked or source.get('tier') == 'error':
+            continue
+        for chunk_index, passage in enumerate(split_passages(text, chunk_size, overlap)[:max_passages]):
+            passages.append({'title': source['title'], 'link': source['link'], 'text': passage, 'chunk_index': chunk_index})
+    return passages
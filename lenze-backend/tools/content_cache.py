@@ -0,0 +1,191 @@
+import asyncio
+import sqlite3
+import os
+import threading
+import time
+from tools.persistence import write_queue
+
+__all__ = ["ContentCache"]
+
+
+class ContentCache:
+    """
+    Persistent cache of extracted page text keyed by URL and shared across sessions.
+
+    Entries keep the ETag/Last-Modified validators of the response they came from. Fresh entries
+    are served without touching the network, stale ones are revalidated with a conditional GET.
+    The cache is evicted by age and by total text size (least recently used first).
+
+    The connection runs in WAL mode and is only used from worker threads: lookups go through
+    `lookup`, and `store`/`revalidate` hand their writes to the write-behind queue so they share
+    a transaction with other writes. Access times are kept in memory and written with the next
+    batch, so a cache hit does not write at all.
+    """
+    def __init__(self, db_path="./data/content_cache.db", ttl=6 * 3600, max_age=7 * 24 * 3600, max_bytes=200 * 1024 * 1024, evict_every=50):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.writes = 0
+        self.accessed = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.initialize_cache()
+
+    def initialize_cache(self):
+        """
+        Initialize the SQLite cache table.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS content_cache (
+                url TEXT PRIMARY KEY,
+                text TEXT,
+                tier TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL,
+                expires_at REAL,
+                last_access REAL,
+                size INTEGER
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_content_cache_last_access ON content_cache(last_access);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_content_cache_fetched_at ON content_cache(fetched_at);')
+        self.conn.commit()
+
+    def get(self, url):
+        """
+        Look up a URL. Returns None on a miss, otherwise a dictionary with the cached text,
+        its validators and whether it is still 'fresh'.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT text, tier, etag, last_modified, fetched_at, expires_at FROM content_cache WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None or now - row[4] > self.max_age:
+                self.misses += 1
+                return None
+            self.accessed[url] = now
+        fresh = now < row[5]
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale += 1
+        return {'text': row[0], 'tier': row[1], 'etag': row[2], 'last_modified': row[3], 'fresh': fresh}
+
+    async def lookup(self, url):
+        """
+        `get` run in a worker thread.
+        """
+        return await asyncio.to_thread(self.get, url)
+
+    def store(self, url, text, tier, etag=None, last_modified=None):
+        """
+        Queue freshly extracted text for a URL to be written by the write-behind queue.
+        """
+        write_queue.submit(self.put, (url, text, tier, etag, last_modified, time.time()))
+
+    def revalidate(self, url):
+        """
+        Queue marking a stale entry fresh again after the origin answered 304 Not Modified.
+        """
+        self.revalidated += 1
+        write_queue.submit(self.refresh, (url, time.time()))
+
+    def put(self, entries):
+        """
+        Write entries queued by `store` in one transaction, along with pending access times.
+
+        :param entries: List of (url, text, tier, etag, last_modified, fetched_at) tuples.
+        """
+        rows = [(url, text, tier, etag, last_modified, now, now + self.ttl, now, len(text.encode('utf-8')))
+                for url, text, tier, etag, last_modified, now in entries]
+        with self.lock:
+            self._flush_accessed()
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO content_cache (url, text, tier, etag, last_modified, fetched_at, expires_at, last_access, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.commit()
+
+        writes = self.writes
+        self.writes += len(rows)
+        if writes // self.evict_every != self.writes // self.evict_every:
+            self.evict()
+
+    def refresh(self, entries):
+        """
+        Write revalidations queued by `revalidate` in one transaction.
+
+        :param entries: List of (url, revalidated_at) tuples.
+        """
+        with self.lock:
+            self._flush_accessed()
+            self.conn.executemany('UPDATE content_cache SET expires_at = ?, last_access = ? WHERE url = ?',
+                                  [(now + self.ttl, now, url) for url, now in entries])
+            self.conn.commit()
+
+    def _flush_accessed(self):
+        """
+        Write access times recorded by `get`. Called with the lock held, the caller commits.
+        """
+        if self.accessed:
+            self.conn.executemany('UPDATE content_cache SET last_access = ? WHERE url = ?',
+                                  [(now, url) for url, now in self.accessed.items()])
+            self.accessed = {}
+
+    def evict(self):
+        """
+        Drop entries older than `max_age`, then the least recently used ones until the cached
+        text fits in `max_bytes`.
+        """
+        with self.lock:
+            # Recent hits must count before the least recently used entries are picked
+            self._flush_accessed()
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM content_cache WHERE fetched_at < ?', (time.time() - self.max_age,))
+            total = cursor.execute('SELECT COALESCE(SUM(size), 0) FROM content_cache').fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                doomed = []
+                for url, size in cursor.execute('SELECT url, size FROM content_cache ORDER BY last_access'):
+                    doomed.append((url,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                cursor.executemany('DELETE FROM content_cache WHERE url = ?', doomed)
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM content_cache').fetchone()
+        lookups = self.hits + self.stale + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'revalidated': self.revalidated,
+            'hit_rate': (self.hits + self.revalidated) / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def close(self):
+        """
+        Write pending access times and close the connection. Stop the write queue first.
+        """
+        with self.lock:
+            self._flush_accessed()
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,140 @@
+import hashlib
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import numpy as np
+from tools.metrics import metrics
+
+__all__ = ["canonical_url", "simhash", "DuplicateFilter"]
+
+WORD = re.compile(r'\w+')
+
+# Query parameters that only track where a visitor came from
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', 'ref', 'ref_src',
+                             'referrer', 'cmpid', 'ncid', 'sr_share', 'amp'])
+TRACKING_PREFIXES = ('utm_', 'pk_', 'hsa_')
+# Host prefixes of mobile and AMP mirrors
+MIRROR_PREFIXES = ('www.', 'm.', 'mobile.', 'amp.')
+
+DUPLICATES = metrics.counter('lenze_duplicate_sources_total', 'Search results skipped as duplicates before embedding.', ('kind',))
+
+
+def canonical_url(url):
+    """
+    Reduce a URL to a key shared by its trivial variants: scheme, `www.`/`m.`/`amp.` hosts, default
+    ports, fragments, tracking parameters, parameter order, trailing slashes and `/amp` paths.
+
+    A mirror prefix is only removed when a registrable name is left (`amp.dev` stays as it is),
+    and `/amp` only when it ends a longer path (`site.com/amp` is not the home page).
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    for prefix in MIRROR_PREFIXES:
+        if host.startswith(prefix) and host.count('.', len(prefix)) >= 1:
+            host = host[len(prefix):]
+            break
+    port = parts.port if parts.port not in (None, 80, 443) else None
+    netloc = f'{host}:{port}' if port else host
+
+    path = re.sub(r'/+', '/', parts.path or '/')
+    path = re.sub(r'(?<=[^/])/amp/?$|\.amp$|/index\.(?:html?|php)$', '', path)
+    path = path.rstrip('/') or '/'
+
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES))
+    return urlunsplit(('', netloc, path, urlencode(query), ''))
+
+
+def _word_hashes(words):
+    hashes = {}
+    for word in words:
+        if word not in hashes:
+            hashes[word] = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+    return np.array([hashes[word] for word in words], dtype=np.uint64)
+
+
+def simhash(text, shingle_size=3):
+    """
+    64-bit SimHash of the word shingles of a text. Texts that share most of their shingles get
+    fingerprints a few bits apart.
+    """
+    words = WORD.findall(text.lower())
+    if not words:
+        return 0
+    hashes = _word_hashes(words)
+    # Shingle hashes combine the hashes of their words, each rotated by its position
+    size = max(1, min(shingle_size, len(words)))
+    count = len(words) - size + 1
+    shingles = hashes[:count].copy()
+    for offset in range(1, size):
+        part = hashes[offset:offset + count]
+        shingles ^= (part << np.uint64(offset)) | (part >> np.uint64(64 - offset))
+    # Spread the bits again so shingles sharing words do not share bits
+    shingles *= np.uint64(0x9E3779B97F4A7C15)
+    shingles ^= shingles >> np.uint64(29)
+    # One row of 64 bits per shingle; each fingerprint bit is the majority vote of its column
+    bits = np.unpackbits(shingles.view(np.uint8).reshape(-1, 8), axis=1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > count
+    return int.from_bytes(np.packbits(votes).tobytes(), 'big')
+
+
+class DuplicateFilter:
+    """
+    Drop repeated and near-duplicate search results before they are embedded.
+
+    URLs are compared by `canonical_url`. Texts are compared by SimHash: two texts are duplicates
+    when their fingerprints differ in at most `max_distance` bits. Fingerprints are indexed in
+    `max_distance + 1` bands, any two within that distance share a band exactly, so each check
+    only compares against the few fingerprints in matching bands and a batch is filtered in
+    linear time.
+    """
+    def __init__(self, max_distance=7, min_chars=200):
+        self.max_distance = max_distance
+        self.min_chars = min_chars
+        self.band_bits = 64 // (max_distance + 1)
+        self.bands = [{} for _ in range(max_distance + 1)]
+        self.urls = set()
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (band * self.band_bits)) & mask for band in range(len(self.bands))]
+
+    def new_sources(self, sources):
+        """
+        Keep the search results whose URL was neither seen before nor repeated earlier in the list.
+
+        :param sources: List of dictionaries with a 'link' key.
+        """
+        kept = []
+        batch = set()
+        for source in sources:
+            key = canonical_url(source['link'])
+            if key in self.urls or key in batch:
+                DUPLICATES.inc(kind='url')
+                continue
+            batch.add(key)
+            kept.append(source)
+        return kept
+
+    def add_url(self, url):
+        """
+        Remember a URL whose page has been processed.
+        """
+        self.urls.add(canonical_url(url))
+
+    def is_duplicate(self, text):
+        """
+        Check a text against the texts accepted so far, and accept it if it is new. Texts shorter
+        than `min_chars` (error messages, stubs) are never treated as duplicates.
+        """
+        if len(text) < self.min_chars:
+            return False
+        fingerprint = simhash(text)
+        keys = self._band_keys(fingerprint)
+        for band, key in zip(self.bands, keys):
+            for other in band.get(key, ()):
+                if (fingerprint ^ other).bit_count() <= self.max_distance:
+                    DUPLICATES.inc(kind='text')
+                    return True
+        for band, key in zip(self.bands, keys):
+            band.setdefault(key, []).append(fingerprint)
+        return False
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+__all__ = ["DomainGuard"]
+
+
+def domain_of(url):
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+class _DomainState:
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.open_seconds = 0.0
+        self.probing = False
+        self.last_failure = None
+
+
+class DomainGuard:
+    """
+    Per-domain concurrency limits and circuit breaker shared by every scrape.
+
+    At most `per_domain` pages of a domain are fetched at once across all requests. Timeouts,
+    errors and JS walls count as failures: after one, the domain's pages get the shorter
+    `degraded_timeout`; after `failure_threshold` in a row the circuit opens and the domain is
+    skipped for `open_seconds`. Once that passes a single probe is let through; if it fails too
+    the circuit opens again for twice as long, up to `max_open_seconds`. Any success closes it.
+    """
+    def __init__(self, per_domain=4, failure_threshold=3, open_seconds=120, max_open_seconds=1800, degraded_timeout=4, max_domains=10000):
+        self.per_domain = per_domain
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.degraded_timeout = degraded_timeout
+        self.max_domains = max_domains
+        self.domains = OrderedDict()
+        self.skipped = 0
+
+    def _state(self, domain):
+        state = self.domains.get(domain)
+        if state is None:
+            state = self.domains[domain] = _DomainState(self.per_domain)
+            if len(self.domains) > self.max_domains:
+                # Forget the least recently used idle domain
+                for name, old in self.domains.items():
+                    if old.active == 0 and name != domain:
+                        del self.domains[name]
+                        break
+        self.domains.move_to_end(domain)
+        return state
+
+    def admit(self, url, timeout):
+        """
+        Decide whether a URL is fetched and with which timeout.
+
+        :return: Tuple of (allowed, timeout). `allowed` is False while the domain's circuit is open.
+        """
+        state = self._state(domain_of(url))
+        if state.failures >= self.failure_threshold:
+            if time.monotonic() < state.open_until or state.probing:
+                self.skipped += 1
+                return False, timeout
+            # Half open: this page is the probe
+            state.probing = True
+            return True, min(timeout, self.degraded_timeout)
+        if state.failures:
+            return True, min(timeout, self.degraded_timeout)
+        return True, timeout
+
+    @asynccontextmanager
+    async def slot(self, url):
+        """
+        Hold one of the domain's concurrent fetch slots.
+        """
+        state = self._state(domain_of(url))
+        async with state.semaphore:
+            state.active += 1
+            try:
+                yield
+            finally:
+                state.active -= 1
+
+    def record_success(self, url):
+        state = self._state(domain_of(url))
+        state.failures = 0
+        state.open_seconds = 0.0
+        state.probing = False
+
+    def abandon(self, url):
+        """
+        Forget a fetch that was cancelled before it succeeded or failed, so a cancelled probe
+        does not keep the circuit from closing.
+        """
+        self._state(domain_of(url)).probing = False
+
+    def record_failure(self, url, reason):
+        """
+        :param reason: 'timeout', 'error' or 'js_wall'.
+        """
+        domain = domain_of(url)
+        state = self._state(domain)
+        state.failures += 1
+        state.last_failure = reason
+        if state.failures >= self.failure_threshold:
+            was_probing, state.probing = state.probing, False
+            if was_probing or not state.open_seconds:
+                state.open_seconds = min(self.max_open_seconds, state.open_seconds * 2 or self.open_seconds)
+                state.open_until = time.monotonic() + state.open_seconds
+                print(f'Circuit open for {domain} for {state.open_seconds:.0f} seconds after {state.failures} failures ({reason})')
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'domains': len(self.domains),
+            'skipped': self.skipped,
+            'open': sorted(domain for domain, state in self.domains.items()
+                           if state.failures >= self.failure_threshold and now < state.open_until),
+            'degraded': sorted(domain for domain, state in self.domains.items()
+                               if 0 < state.failures < self.failure_threshold)
+        }
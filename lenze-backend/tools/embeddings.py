@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import sqlite3
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from openai import AsyncOpenAI
+from tools.metrics import EMBED_SECONDS, timed, record_usage
+from tools.persistence import write_queue
+from tools.quantization import DTYPES, encode, decode
+
+__all__ = ["EmbeddingService", "shared_embedding_service"]
+
+
+class EmbeddingService:
+    """
+    Batched OpenAI embedding client with a content-hash cache.
+
+    Texts are keyed by a SHA-256 of the model name and text. Lookups go through an in-memory
+    LRU first and a persistent SQLite table second, so repeated sources and repeated queries are
+    never re-embedded. Misses are deduplicated, split into API-sized batches and sent
+    concurrently; one vector is returned per input text, in input order.
+
+    The table runs in WAL mode and is only touched from worker threads: disk lookups run in
+    `asyncio.to_thread`, new vectors and access times are written by the write-behind queue.
+    Like ContentCache it is evicted by age and by total size, least recently used first.
+    Vectors are stored as `dtype` (see tools.quantization), recorded per row like in the sources
+    table, so an int8 store does not keep a float32 copy of every passage here.
+    """
+    def __init__(self, model="text-embedding-3-small", batch_size=256, max_concurrency=4, cache_size=10000, db_path="./data/embeddings.db",
+                 client: AsyncOpenAI = None, max_age=30 * 24 * 3600, max_bytes=256 * 1024 * 1024, evict_every=2000, flush_accessed=1000, dtype='float32'):
+        if dtype not in DTYPES:
+            raise ValueError(f'Unknown embedding dtype {dtype}, expected one of {", ".join(DTYPES)}')
+        self.model = model
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache_size = cache_size
+        self.memory = OrderedDict()
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.flush_accessed = flush_accessed
+        self.writes = 0
+        self.accessed = {}
+        self.lock = threading.Lock()
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.initialize_cache()
+
+    def initialize_cache(self):
+        """
+        Create the embeddings table, adding the columns eviction needs to tables from before it.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                hash TEXT PRIMARY KEY,
+                embedding BLOB,
+                created_at REAL,
+                last_access REAL,
+                size INTEGER,
+                dtype TEXT NOT NULL DEFAULT 'float32'
+            )
+        ''')
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(embeddings)')]
+        if 'created_at' not in columns:
+            # Existing vectors start aging now
+            for column in ('created_at REAL', 'last_access REAL', 'size INTEGER'):
+                cursor.execute(f'ALTER TABLE embeddings ADD COLUMN {column}')
+            now = time.time()
+            cursor.execute('UPDATE embeddings SET created_at = ?, last_access = ?, size = length(embedding)', (now, now))
+        if 'dtype' not in columns:
+            # Vectors stored so far are float32
+            cursor.execute("ALTER TABLE embeddings ADD COLUMN dtype TEXT NOT NULL DEFAULT 'float32'")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_created_at ON embeddings(created_at);')
+        self.conn.commit()
+
+    def _hash(self, text):
+        return hashlib.sha256(f'{self.model}\x00{text}'.encode('utf-8')).hexdigest()
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.cache_size:
+            self.memory.popitem(last=False)
+
+    async def _lookup(self, keys):
+        """
+        Resolve as many hashes as possible from memory, then from disk.
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+                self.accessed[key] = now
+            else:
+                missing.append(key)
+
+        if missing:
+            for key, embedding in (await asyncio.to_thread(self._read, missing)).items():
+                self._remember(key, embedding)
+                found[key] = embedding
+                self.accessed[key] = now
+        return found
+
+    def _read(self, keys):
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f'SELECT hash, embedding, dtype FROM embeddings WHERE hash IN ({placeholders})', chunk).fetchall()
+                for key, blob, dtype in rows:
+                    found[key] = decode(blob, dtype)
+        return found
+
+    def write(self, batches):
+        """
+        Write vectors queued by `embed` in one transaction, along with pending access times.
+
+        :param batches: List of lists of (hash, embedding) tuples.
+        """
+        now = time.time()
+        blobs = [(key, encode(embedding, self.dtype)) for batch in batches for key, embedding in batch]
+        rows = [(key, blob, now, now, len(blob), self.dtype) for key, blob in blobs]
+        # Swapped rather than iterated, the loop keeps recording hits meanwhile
+        accessed, self.accessed = self.accessed, {}
+        accessed = list(accessed.items())
+        with self.lock:
+            self.conn.executemany('UPDATE embeddings SET last_access = ? WHERE hash = ?', [(at, key) for key, at in accessed])
+            self.conn.executemany('INSERT OR REPLACE INTO embeddings (hash, embedding, created_at, last_access, size, dtype) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+        writes = self.writes
+        self.writes += len(rows)
+        if writes // self.evict_every != self.writes // self.evict_every:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop vectors older than `max_age`, then the least recently used ones until the table
+        fits in `max_bytes`.
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM embeddings WHERE created_at < ?', (time.time() - self.max_age,))
+            total = cursor.execute('SELECT COALESCE(SUM(size), 0) FROM embeddings').fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                doomed = []
+                for key, size in cursor.execute('SELECT hash, size FROM embeddings ORDER BY last_access'):
+                    doomed.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                cursor.executemany('DELETE FROM embeddings WHERE hash = ?', doomed)
+            self.conn.commit()
+
+    async def _embed_batch(self, texts):
+        if self.client is None:
+            self.client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        async with self.semaphore:
+            with timed(EMBED_SECONDS):
+                response = await self.client.embeddings.create(input=texts, model=self.model)
+        record_usage(self.model, getattr(response, 'usage', None))
+        # The API reports the input position of each vector, do not rely on response order
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = np.array(item.embedding, dtype=np.float32)
+        return embeddings
+
+    def peek(self, text):
+        """
+        Return the embedding of a text if it is in the in-memory cache, without calling the API.
+        """
+        return self.memory.get(self._hash(text))
+
+    async def embed(self, texts):
+        """
+        Embed a list of texts.
+
+        :param texts: List of strings.
+
+        :return: List of float32 numpy arrays, one per input text and in the same order.
+        """
+        keys = [self._hash(text) for text in texts]
+        found = await self._lookup(set(keys))
+
+        # Deduplicate the misses so each distinct text is sent once
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        self.hits += len(texts) - len(pending)
+        self.misses += len(pending)
+
+        if pending:
+            pending_keys = list(pending)
+            batches = [pending_keys[i:i + self.batch_size] for i in range(0, len(pending_keys), self.batch_size)]
+            results = await asyncio.gather(*(self._embed_batch([pending[key] for key in batch]) for batch in batches))
+            rows = []
+            for batch, embeddings in zip(batches, results):
+                for key, embedding in zip(batch, embeddings):
+                    found[key] = embedding
+                    self._remember(key, embedding)
+                    rows.append((key, embedding))
+            write_queue.submit(self.write, rows)
+        elif len(self.accessed) >= self.flush_accessed:
+            # Only hits lately, write their access times on their own
+            write_queue.submit(self.write, [])
+
+        return [found[key] for key in keys]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'memory_entries': len(self.memory)}
+
+    def close(self):
+        """
+        Close the connection. Stop the write queue first so queued vectors are written.
+        """
+        with self.lock:
+            self.conn.close()
+
+
+_shared_service = None
+
+
+def shared_embedding_service():
+    """
+    Service shared by every Sources instance so the cache spans sessions. It is created on first
+    use, importing this module does not create the database.
+    """
+    global _shared_service
+    if _shared_service is None:
+        _shared_service = EmbeddingService(dtype=os.getenv('EMBEDDING_DTYPE', 'float32'))
+    return _shared_service
@@ -1,44 +1,96 @@
 import os
+import asyncio
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
+from tools.http_client import HttpClient
 
 # Load the environment variables from the .env file
 load_dotenv()
 my_api_key = os.getenv('GOOGLE_API_KEY')
 my_cse_id = os.getenv('CSE_ID')
 
+CUSTOM_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+
 class SearchEngine():
+    """
+    Async client for Google Custom Search and YouTube search.
 
-    def __init__(self):
+    Requests go over the shared pooled HTTP session, result pages are fetched concurrently and
+    results are kept in a TTL cache keyed by the query and its parameters.
+    """
+    def __init__(self, http_client: HttpClient = None, cache_ttl=600, cache_size=512, custom_search_url=CUSTOM_SEARCH_URL, youtube_search_url=YOUTUBE_SEARCH_URL):
         self.api_key = my_api_key
         self.cse_id = my_cse_id
-        self.customsearch = build("customsearch", "v1", developerKey=self.api_key)
-        self.youtube = build("youtube", "v3", developerKey=self.api_key)
+        self.http_client = http_client or HttpClient()
+        self.custom_search_url = custom_search_url
+        self.youtube_search_url = youtube_search_url
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def _cache_get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.time() > expires_at:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, key, value):
+        self.cache[key] = (time.time() + self.cache_ttl, value)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _get_json(self, url, params):
+        await self.http_client.start()
+        async with self.http_client.session.get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def web_search(self, search_term, num=10, **kwargs):
 
-    def web_search(self, search_term, num=10, **kwargs):
+        key = ('web', search_term, num, tuple(sorted(kwargs.items())))
+        cached = self._cache_get(key)
+        if cached is None:
+            # Every result page is requested at once, so 20-30 results cost one round trip
+            pages = await asyncio.gather(*(
+                self._get_json(self.custom_search_url, {'q': search_term, 'cx': self.cse_id, 'key': self.api_key, 'start': start, 'num': 10, **kwargs})
+                for start in range(1, num, 10)
+            ))
+            all_sources = []
+            for res in pages:
+                all_sources.extend({'title': result['title'], 'link': result['link']} for result in res.get('items', []))
+            cached = all_sources[:num]
+            self._cache_put(key, cached)
 
-        all_sources = []
-        start = 1
-        while start < num:
-            res = self.customsearch.cse().list(q=search_term, cx=self.cse_id, start=start, num=10, **kwargs).execute()
-            start += 10
-            sources = [{'title': result['title'], 'link': result['link']} for result in res['items']]
-            all_sources.extend(sources)
+        # Callers add scraped text to these dictionaries, never hand out the cached ones
+        return [dict(source) for source in cached]
 
-        return all_sources[:num]
+    async def image_search(self, search_term, **kwargs):
 
-    def image_search(self, search_term, **kwargs):
+        key = ('image', search_term, tuple(sorted(kwargs.items())))
+        image_urls = self._cache_get(key)
+        if image_urls is None:
+            res = await self._get_json(self.custom_search_url, {'q': search_term, 'cx': self.cse_id, 'key': self.api_key, 'searchType': 'image', **kwargs})
+            image_urls = [item['link'] for item in res.get('items', [])]
+            self._cache_put(key, image_urls)
 
-        res = self.customsearch.cse().list(q=search_term, cx=self.cse_id, searchType = "image", **kwargs).execute()
-        image_urls = [item['link'] for item in res['items']]
+        return list(image_urls)
 
-        return image_urls
+    async def video_search(self, search_term, **kwargs):
 
-    def video_search(self, search_term, **kwargs):
+        key = ('video', search_term, tuple(sorted(kwargs.items())))
+        video_ids = self._cache_get(key)
+        if video_ids is None:
+            params = {'q': search_term, 'key': self.api_key, 'part': 'snippet', 'type': 'video', 'maxResults': 5, **kwargs}
+            res = await self._get_json(self.youtube_search_url, params)
+            video_ids = [item['id']['videoId'] for item in res.get('items', [])]
+            self._cache_put(key, video_ids)
 
-        request = self.youtube.search().list(q=search_term, part='snippet', type='video', maxResults=5)
-        res = request.execute()
-        video_ids = [item['id']['videoId'] for item in res['items']]
-        
-        return video_ids
-        
+        return list(video_ids)
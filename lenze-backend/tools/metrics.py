@@ -0,0 +1,207 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__all__ = ["MetricsRegistry", "metrics", "span", "timed", "record_stage", "record_usage"]
+
+# Seconds, from a cache hit to a slow page load or a long answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of label values.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name + _labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram, one set of buckets per combination of label values.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        position = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append((f'{self.name}_bucket' + _labels(self.labelnames, key, f'le="{bound}"'), cumulative))
+            lines.append((f'{self.name}_sum' + _labels(self.labelnames, key), total))
+            lines.append((f'{self.name}_count' + _labels(self.labelnames, key), count))
+        return lines
+
+
+class Gauge:
+    """
+    Value read from a callback when the metrics are rendered, for state kept elsewhere.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def samples(self):
+        try:
+            return [(self.name, self.callback())]
+        except Exception:
+            return []
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics, rendered in the Prometheus text format.
+
+    Recording a value is a dictionary lookup and a few additions under an uncontended lock,
+    cheap enough to leave on for every request.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        return self._register(Gauge(name, documentation, callback))
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{sample} {_number(value)}' for sample, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by the whole process, served on /metrics
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram('lenze_stage_seconds', 'Duration of search pipeline stages.', ('stage',))
+FETCH_SECONDS = metrics.histogram('lenze_fetch_seconds', 'Time to fetch one URL, by the tier that served it.', ('tier',))
+TIER_SECONDS = metrics.histogram('lenze_tier_attempt_seconds', 'Duration of each fetch tier attempt.', ('tier',))
+EXTRACT_SECONDS = metrics.histogram('lenze_extract_seconds', 'Text extraction time, queueing included.', ('kind',))
+EMBED_SECONDS = metrics.histogram('lenze_embed_request_seconds', 'Duration of embedding API calls.')
+LLM_SECONDS = metrics.histogram('lenze_llm_request_seconds', 'Duration of chat completion calls.', ('stream',))
+FETCHED_BYTES = metrics.counter('lenze_fetched_bytes_total', 'Bytes downloaded while scraping, by tier.', ('tier',))
+BLOCKED_REQUESTS = metrics.counter('lenze_blocked_requests_total', 'Browser subresource requests aborted by the resource policy.')
+PAGES = metrics.counter('lenze_pages_total', 'URLs scraped, by the tier that served them.', ('tier',))
+TOKENS = metrics.counter('lenze_tokens_total', 'Tokens reported by the OpenAI API.', ('model', 'kind'))
+RETRIEVALS = metrics.counter('lenze_retrievals_total', 'Source retrievals, by how passages were found.', ('mode',))
+EXTRACTED_CHARS = metrics.counter('lenze_extracted_chars_total', 'Characters of text extracted from pages.', ('kind',))
+
+
+def record_stage(stage, seconds, timings=None):
+    """
+    Record the duration of a pipeline stage, and in `timings` too when given.
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is not None:
+        timings[stage] = seconds
+
+
+@contextmanager
+def span(stage, timings=None):
+    """
+    Time the block as a pipeline stage. Stages that raise are recorded too.
+
+    :param timings: Optional dictionary the duration is also written to, under `stage`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, timings)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Record the duration of the block in `histogram`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def record_usage(model, usage):
+    """
+    Count the tokens of an OpenAI `usage` object, which may be missing.
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+    if prompt_tokens:
+        TOKENS.inc(prompt_tokens, model=model, kind='prompt')
+    if completion_tokens:
+        TOKENS.inc(completion_tokens, model=model, kind='completion')
@@ -0,0 +1,36 @@
+import fitz  # PyMuPDF
+
+__all__ = ["PdfExtractionError", "extract_text_from_pdf"]
+
+
+class PdfExtractionError(Exception):
+    """
+    A PDF could not be downloaded whole or could not be opened.
+    """
+
+
+def extract_text_from_pdf(pdf_buffer, max_content=5000):
+    """
+    Extract text from a PDF page by page, stopping as soon as `max_content` characters are
+    collected so long documents are never parsed in full.
+
+    :raises PdfExtractionError: If the document cannot be opened.
+    """
+    try:
+        pdf_document = fitz.open(stream=pdf_buffer, filetype="pdf")
+    except Exception as e:
+        raise PdfExtractionError(f"Error extracting text from PDF: {str(e)}") from None
+    with pdf_document:
+        pages = []
+        size = 0
+        for page in pdf_document:
+            try:
+                text = page.get_text()
+            except Exception:
+                # A damaged page should not cost the pages already read
+                continue
+            pages.append(text)
+            size += len(text)
+            if size >= max_content:
+                break
+    return ''.join(pages)[:max_content]
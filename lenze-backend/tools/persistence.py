@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+__all__ = ["WriteBehindQueue", "write_queue"]
+
+
+class WriteBehindQueue:
+    """
+    Write-behind queue that takes database writes off the request path.
+
+    `submit` only enqueues. A worker task collects whatever is queued (waiting `max_delay` for
+    more to arrive), groups the items by handler and calls each handler once with its items
+    in a worker thread, so many writes share one transaction and one fsync. Handlers are
+    callables taking a list of items and writing them in a single transaction.
+    """
+    def __init__(self, max_batch=500, max_delay=0.05):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.worker = None
+        self.in_flight = 0
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.last_flush = 0.0
+
+    def start(self):
+        if self.worker is None or self.worker.done():
+            if self.queue is None:
+                self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Write everything still queued, then stop the worker.
+        """
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+        self.queue = None
+
+    def submit(self, handler, item):
+        """
+        Queue one item to be written by `handler`.
+
+        :return: Future resolved once the item's batch is handled, with True if it was written.
+                 Callers that do not need to know can ignore it.
+        """
+        self.start()
+        written = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((handler, item, written))
+        return written
+
+    @property
+    def depth(self):
+        """
+        Number of items queued or being written.
+        """
+        return (self.queue.qsize() if self.queue else 0) + self.in_flight
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        self.in_flight = 1
+        # Give writes finishing at about the same time a chance to join this transaction
+        if self.max_delay:
+            await asyncio.sleep(self.max_delay)
+        while len(batch) < self.max_batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            self.in_flight = len(batch)
+            groups = {}
+            for handler, item, written in batch:
+                groups.setdefault(handler, []).append((item, written))
+
+            start = time.time()
+            for handler, entries in groups.items():
+                items = [item for item, _ in entries]
+                try:
+                    await asyncio.to_thread(handler, items)
+                    self.written += len(items)
+                    success = True
+                except Exception as e:
+                    self.failed += len(items)
+                    success = False
+                    print(f'Failed to write {len(items)} items with {getattr(handler, "__qualname__", handler)}: {str(e)}')
+                for _, written in entries:
+                    if not written.done():
+                        written.set_result(success)
+            self.last_flush = time.time() - start
+            self.batches += 1
+
+            self.in_flight = 0
+            for _ in batch:
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'batches': self.batches,
+            'written': self.written,
+            'failed': self.failed,
+            'last_flush_seconds': self.last_flush
+        }
+
+
+# Shared by every request so writes from concurrent streams are grouped together
+write_queue = WriteBehindQueue()
@@ -0,0 +1,90 @@
+import numpy as np
+
+__all__ = ["DTYPES", "quantize", "dequantize", "encode", "decode", "scores"]
+
+# Storage formats of embeddings, from exact to most compact. float16 is not offered: numpy has no
+# BLAS product for it, so every query would widen the whole matrix and run several times slower
+DTYPES = ('float32', 'int8')
+INT8_MAX = 127.0
+# Rows per block when scoring compact vectors, keeps the float32 copy made for the product in cache
+BLOCK_ROWS = 512
+
+
+def quantize(vectors, dtype):
+    """
+    Convert float32 vectors to a storage format.
+
+    int8 vectors get one float32 scale each, the largest absolute component divided by 127, so
+    every vector uses the full int8 range.
+
+    :param vectors: 2-D float32 array.
+    :param dtype: One of DTYPES.
+
+    :return: Tuple of (codes, scales). `scales` is None except for int8.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == 'float32':
+        return vectors, None
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / INT8_MAX
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f'Unknown embedding dtype {dtype}, expected one of {", ".join(DTYPES)}')
+
+
+def dequantize(codes, scales=None):
+    """
+    :return: float32 vectors from `quantize` output.
+    """
+    vectors = np.asarray(codes).astype(np.float32)
+    if scales is not None:
+        vectors *= np.asarray(scales, dtype=np.float32).reshape(-1, 1)
+    return vectors
+
+
+def encode(vector, dtype):
+    """
+    Encode one float32 vector as a BLOB. An int8 BLOB starts with its float32 scale.
+    """
+    codes, scales = quantize(np.asarray(vector, dtype=np.float32).reshape(1, -1), dtype)
+    if scales is None:
+        return codes.tobytes()
+    return scales.tobytes() + codes.tobytes()
+
+
+def decode(blob, dtype='float32'):
+    """
+    Decode a BLOB written by `encode` back to a float32 vector.
+    """
+    if dtype is None or dtype == 'float32':
+        return np.frombuffer(blob, dtype=np.float32)
+    if dtype == 'float16':
+        # Not written any more, kept so such rows still read
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+    if dtype == 'int8':
+        scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+        return np.frombuffer(blob, dtype=np.int8, offset=4).astype(np.float32) * scale
+    raise ValueError(f'Unknown embedding dtype {dtype}, expected one of {", ".join(DTYPES)}')
+
+
+def scores(codes, scales, query):
+    """
+    Dot products of stored vectors with a float32 query, computed on the stored form.
+
+    float32 rows go straight to a matrix-vector product. Compact rows are widened one block at
+    a time, so no float32 copy of the whole matrix is ever made, and int8 products are scaled
+    afterwards, one multiplication per row instead of per component.
+
+    :return: float32 array with one score per row.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    if codes.dtype == np.float32:
+        return codes @ query
+    result = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), BLOCK_ROWS):
+        block = codes[start:start + BLOCK_ROWS]
+        result[start:start + len(block)] = block.astype(np.float32) @ query
+    if scales is not None:
+        result *= scales
+    return result
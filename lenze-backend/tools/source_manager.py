@@ -1,115 +1,255 @@
-import sqlite3
+import asyncio
+import re
 import numpy as np
-import openai
-import os
-from sklearn.metrics.pairwise import cosine_similarity
-import time
-
-# Set your OpenAI API key
-openai.api_key = os.getenv('OPENAI_API_KEY')
+from tools.text_extraction import BLOCKED_CONTENT
+from tools.embeddings import EmbeddingService, shared_embedding_service
+from tools.vector_index import IndexRegistry, index_registry
+from tools.source_store import SourceStore, shared_source_store, query_terms
+from tools.persistence import WriteBehindQueue, write_queue
+from tools.metrics import RETRIEVALS, span
 
 class Sources:
-    def __init__(self, session_id):
+    def __init__(self, session_id, embedder: EmbeddingService = None, registry: IndexRegistry = None, store: SourceStore = None, writer: WriteBehindQueue = None):
         self.session_id = session_id
-        self.db_path = "./data/sources.db"  # Common database for all sessions
-        self.table_name = f"sources_{session_id}"  # Unique table for each session
-        self.initialize_sources()
-
-    def initialize_sources(self):
-        """
-        Initialize the SQLite database.
-        """
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {self.table_name} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                link TEXT,
-                text TEXT,
-                embedding BLOB
-            )
-        ''')
-        # Create an index on the embedding column for faster queries
-        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_embedding ON {self.table_name}(embedding);')
-        conn.commit()
-        conn.close()
-
-    def generate_embeddings(self, texts):
-        """
-        Generate embeddings using the OpenAI API for the given texts in batch.
-        """
-        response = openai.embeddings.create(
-            input=texts,
-            model="text-embedding-3-small"
-        )
-        embeddings = [np.array(e, dtype=np.float32).tobytes() for e in response.data[0].embedding]
-        return embeddings
-
-    def store_data(self, data):
+        self.embedder = embedder or shared_embedding_service()
+        self.registry = registry or index_registry
+        self.store = store or shared_source_store()
+        self.writer = writer or write_queue
+        self.table_name = "sources"  # Every session shares one table keyed by session_id
+        self.index_name = f"session_{session_id}"
+        # Writes queued by store_data, full-text search only sees them once they are committed
+        self.pending_writes = []
+
+    async def generate_embeddings(self, texts):
         """
-        Store data locally into the SQLite database using batch insertions.
+        Generate embeddings for the given texts in batch, one float32 vector per text.
+        """
+        return await self.embedder.embed(texts)
+
+    async def store_data(self, data):
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Store data locally into the SQLite database using batch insertions.
 
-        start_time = time.time()
+        :return: List of the stored entries, each with its 'embedding'.
+        """
         batch_data = []
         texts_for_embedding = []
 
         for entry in data:
-            if entry['text'] and entry['text'] not in ['Error fetching content.', 'Enable JavaScript and cookies to continue', 'Please enable JS and disable any ad blocker', 'Access Denied']:
+            if entry['text'] and entry['text'] not in BLOCKED_CONTENT:
                 texts_for_embedding.append(entry['text'])
-                batch_data.append((entry['title'], entry['link'], entry['text']))
+                batch_data.append((entry['title'], entry['link'], entry['text'], entry.get('chunk_index', 0)))
 
-        embeddings = self.generate_embeddings(texts_for_embedding)
+        with span('embed'):
+            embeddings = await self.generate_embeddings(texts_for_embedding)
 
-        batch_insert_data = [(batch_data[i][0], batch_data[i][1], batch_data[i][2], embeddings[i]) for i in range(len(batch_data))]
+        if batch_data:
+            # Reserving ids can wait on the database lock, so it is done off the event loop
+            await self.store.reserve_ahead(len(batch_data))
+            # Load the index before staging so the new rows are only added once
+            index = self.index
+            global_index = self.registry.peek('global')
 
-        cursor.executemany(f'''
-            INSERT INTO {self.table_name} (title, link, text, embedding) VALUES (?, ?, ?, ?)
-        ''', batch_insert_data)
+            # Ids are assigned now and the rows are readable at once, the commit is queued
+            rows = [(title, link, text, embeddings[i], chunk_index) for i, (title, link, text, chunk_index) in enumerate(batch_data)]
+            row_ids = self.store.stage(self.session_id, rows)
+            written = self.writer.submit(self.store.write_staged, row_ids)
+            written.add_done_callback(lambda written: self._forget_unwritten(row_ids, written))
+            self.pending_writes.append(written)
 
-        end_time = time.time()
+            index.add(row_ids, np.stack(embeddings))
+            self.registry.mark_dirty(self.index_name)
+            if global_index is not None:
+                global_index.add(row_ids, np.stack(embeddings))
 
-        conn.commit()
-        conn.close()
+        return [{'title': row[0], 'link': row[1], 'text': row[2], 'chunk_index': row[3], 'embedding': embeddings[i]} for i, row in enumerate(batch_data)]
 
-        print(f'Storing took {end_time-start_time:.4f} seconds')
+    def _forget_unwritten(self, row_ids, written):
+        """
+        Remove rows from the loaded indexes if their write failed, so they are never retrieved.
+        """
+        if not written.cancelled() and written.result():
+            return
+        print(f'Dropping {len(row_ids)} unwritten rows from the index of session {self.session_id}')
+        for name in (self.index_name, 'global'):
+            index = self.registry.peek(name)
+            if index is not None:
+                index.remove(row_ids)
+        self.registry.mark_dirty(self.index_name)
 
     def read_data_streaming(self):
         """
         Read locally stored data from the SQLite database using streaming.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(f'SELECT title, link, text, embedding FROM {self.table_name}')
-        while True:
-            row = cursor.fetchone()
-            if row is None:
-                break
-            yield {'title': row[0], 'link': row[1], 'text': row[2], 'embedding': np.frombuffer(row[3], dtype=np.float32)}
-        conn.close()
+        yield from self.store.iter_session(self.session_id)
 
-    def find_most_relevant_sources(self, query, top_n=5, similarity_threshold=0.5, scope=20):
+    def _load_vectors(self, after_id=0, dim=None):
         """
-        Find the most relevant sources based on cosine similarity using vectorized operations.
+        Read ids and embeddings of rows newer than `after_id` to build the vector index.
         """
-        sources = list(self.read_data_streaming())[-scope:]
+        return self.store.load_vectors(self.session_id, after_id, dim)
 
-        if not sources:
+    def _load_global_vectors(self, after_id=0, dim=None):
+        """
+        Read the rows of every session to build the cross-session index.
+        """
+        return self.store.load_vectors(None, after_id, dim)
+
+    @property
+    def index(self):
+        return self.registry.get(self.index_name, self._load_vectors)
+
+    @staticmethod
+    def _group_passages(passages, top_n, passages_per_source):
+        """
+        Group passages (most similar first) back into sources for citation.
+        """
+        grouped = {}
+        for passage in passages:
+            group = grouped.get(passage['link'])
+            if group is None:
+                if len(grouped) == top_n:
+                    continue
+                group = grouped[passage['link']] = {'title': passage['title'], 'link': passage['link'], 'passages': []}
+            if len(group['passages']) < passages_per_source:
+                group['passages'].append(passage)
+
+        sources = []
+        for group in grouped.values():
+            # Keep the passages in reading order within a source
+            ordered = sorted(group['passages'], key=lambda passage: passage['chunk_index'])
+            sources.append({'title': group['title'], 'link': group['link'], 'text': '\n...\n'.join(passage['text'] for passage in ordered)})
+        return sources
+
+    async def _lexical_candidates(self, query, across_sessions, limit, write_wait):
+        """
+        BM25 candidates for a query, once this instance's queued writes are committed.
+
+        :return: Tuple of (candidates, complete). `complete` is False when some writes were still
+                 queued after `write_wait` seconds, the candidates then miss their rows.
+        """
+        pending = [written for written in self.pending_writes if not written.done()]
+        if pending and write_wait:
+            await asyncio.wait(pending, timeout=write_wait)
+        self.pending_writes = [written for written in self.pending_writes if not written.done()]
+        session_id = None if across_sessions else self.session_id
+        candidates = await asyncio.to_thread(self.store.search_text, query, session_id, limit)
+        return candidates, not self.pending_writes
+
+    @staticmethod
+    def _strong_lexical(passages, terms, min_sources):
+        """
+        Whether at least `min_sources` sources have a passage containing every query term.
+        """
+        links = set()
+        for passage in passages:
+            words = set(re.findall(r'\w+', f"{passage['title']} {passage['text']}".lower()))
+            if all(term in words for term in terms):
+                links.add(passage['link'])
+        return len(links) >= min_sources
+
+    async def find_most_relevant_sources(self, query, top_n=5, similarity_threshold=0.5, scope=200, top_passages=8, passages_per_source=2, across_sessions=False, lexical_candidates=50, min_lexical_sources=3, write_wait=0.1):
+        """
+        Find the most relevant passages and group them by source.
+
+        Retrieval is hybrid: BM25 over the whole session (or every session) picks up to
+        `lexical_candidates` passages, which are rescored by cosine similarity together with the
+        vector search over the `scope` most recent passages. When the best BM25 passages contain
+        every query term in at least `min_lexical_sources` sources, they are used as they are
+        without waiting for the query embedding. A query whose embedding is cached always gets the
+        hybrid search.
+
+        :param top_n: Maximum number of sources returned.
+        :param scope: Only consider the `scope` most recently stored passages of this session. None searches all of them.
+        :param top_passages: Number of passages retrieved before grouping.
+        :param passages_per_source: Maximum number of passages kept per source.
+        :param across_sessions: Search the global index of every session instead of this session's index.
+        :param lexical_candidates: Number of BM25 candidates rescored, 0 for vector search only.
+        :param write_wait: Seconds to wait for queued writes before the BM25 search.
+        """
+        if across_sessions:
+            index = self.registry.get('global', self._load_global_vectors, persist=False)
+            scope = None
+        else:
+            index = self.index
+
+        if len(index) == 0:
             print("No sources found in the database.")
             return []  # Return an empty list or handle this case as needed
 
-        query_embedding = np.frombuffer(self.generate_embeddings([query])[0], dtype=np.float32)
-        source_embeddings = np.stack([source['embedding'] for source in sources])
-        similarities = cosine_similarity([query_embedding], source_embeddings).flatten()
-        
-        filtered_indices = np.where(similarities > similarity_threshold)[0]
-        print(filtered_indices)
-        if filtered_indices.size == 0:
+        # The query is often embedded already, while its pages were scored during the search
+        query_embedding = self.embedder.peek(query)
+        embedding_task = None
+        if query_embedding is None:
+            # Sent while queued writes commit and BM25 runs, and dropped if the lexical match is strong
+            embedding_task = asyncio.create_task(self.generate_embeddings([query]))
+        try:
+            lexical = []
+            if lexical_candidates and self.store.lexical:
+                # Queued writes are only waited for when a strong lexical match can save the embedding
+                wait = write_wait if embedding_task is not None else 0
+                lexical, complete = await self._lexical_candidates(query, across_sessions, lexical_candidates, wait)
+                terms = query_terms(query)
+                if embedding_task is not None and lexical and complete and len(terms) >= 2:
+                    rows = self.store.fetch_rows([row_id for row_id, _ in lexical[:top_passages]])
+                    passages = [rows[row_id] for row_id, _ in lexical[:top_passages] if row_id in rows]
+                    if self._strong_lexical(passages, terms, min(min_lexical_sources, top_n)):
+                        print(f'Strong lexical match, {len(passages)} passages by BM25')
+                        RETRIEVALS.inc(mode='lexical')
+                        return self._group_passages(passages, top_n, passages_per_source)
+
+            if embedding_task is not None:
+                query_embedding = (await embedding_task)[0]
+        finally:
+            if embedding_task is not None and not embedding_task.done():
+                embedding_task.cancel()
+
+        hits = dict(index.search(query_embedding, top_k=top_passages, threshold=similarity_threshold, last=scope))
+        # Older passages found by BM25 are rescored against the query vector
+        extra = [row_id for row_id, _ in lexical if row_id not in hits]
+        for row_id, score in index.score_ids(query_embedding, extra).items():
+            if score > similarity_threshold:
+                hits[row_id] = score
+        hits = sorted(hits.items(), key=lambda hit: hit[1], reverse=True)[:top_passages]
+        RETRIEVALS.inc(mode='hybrid' if lexical else 'vector')
+        print([f'{score:.3f}' for _, score in hits])
+        if not hits:
             return []
 
-        most_relevant_indices = filtered_indices[np.argsort(similarities[filtered_indices])][-top_n:]
-        return [{'title': sources[i]['title'], 'link': sources[i]['link'], 'text': sources[i]['text']} for i in most_relevant_indices]
+        rows = self.store.fetch_rows([row_id for row_id, _ in hits])
+        passages = [rows[row_id] for row_id, _ in hits if row_id in rows]
+        return self._group_passages(passages, top_n, passages_per_source)
+
+
+async def backfill_embeddings(store: SourceStore = None, embedder: EmbeddingService = None, registry: IndexRegistry = None, batch_size=256):
+    """
+    Embed rows stored without an embedding, batch by batch, then drop the indexes of their
+    sessions so they are rebuilt with those rows. Meant to run as a background task.
+
+    :return: Number of rows embedded.
+    """
+    store = store or shared_source_store()
+    embedder = embedder or shared_embedding_service()
+    registry = registry or index_registry
+    sessions = set()
+    embedded = 0
+    try:
+        while True:
+            rows = await asyncio.to_thread(store.unembedded_rows, batch_size)
+            if not rows:
+                break
+            embeddings = await embedder.embed([text for _, _, text in rows])
+            await asyncio.to_thread(store.set_embeddings, [(row_id, embedding) for (row_id, _, _), embedding in zip(rows, embeddings)])
+            sessions.update(session_id for _, session_id, _ in rows)
+            embedded += len(rows)
+    except Exception as e:
+        # Rows left without an embedding are picked up on the next start
+        print(f'Failed to embed stored passages: {str(e)}')
+    finally:
+        # Rows embedded so far sit below the indexed ids, incremental loads would miss them
+        for session_id in sessions:
+            registry.drop(f'session_{session_id}')
+        if sessions:
+            registry.drop('global')
+            print(f'Embedded {embedded} stored passages of {len(sessions)} sessions')
+    return embedded
@@ -0,0 +1,433 @@
+import asyncio
+import sqlite3
+import os
+import re
+import threading
+from collections import Counter
+import numpy as np
+from tools.quantization import DTYPES, encode, decode
+
+__all__ = ["SourceStore", "shared_source_store", "query_terms"]
+
+LEGACY_TABLE_PATTERN = "sources\\_%"
+
+WORD = re.compile(r'\w+')
+# Too common to narrow a full-text search down
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'how', 'i', 'in',
+                       'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where',
+                       'which', 'who', 'why', 'with'])
+
+
+def query_terms(query):
+    """
+    Distinct lower-cased words of a query without stopwords, in query order.
+    """
+    terms = []
+    for word in WORD.findall(query.lower()):
+        if word not in STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms
+
+
+class SourceStore:
+    """
+    SQLite storage for the passages of every session in one `sources` table.
+
+    Rows are keyed by session_id with an index on (session_id, id), so reading a session is a
+    range scan however many sessions exist. The database runs in WAL mode, which lets reads
+    proceed while a write is committing. One long-lived connection is used for writes (from
+    worker threads) and another for reads.
+
+    Rows can also be staged: `stage` hands out row ids at once and keeps the rows in memory,
+    where reads find them, until `write_staged` commits them. This lets the write itself be
+    queued behind the request.
+
+    Titles and texts are also indexed in the `sources_fts` FTS5 table, kept in step with
+    `sources` by triggers, for BM25 search with `search_text`. Where SQLite lacks FTS5,
+    `lexical` is False and only vector search is available.
+
+    Embeddings are written as `embedding_dtype` ('float32' or 'int8', see
+    tools.quantization), recorded per row, so rows written before a change of format are
+    still read correctly.
+    """
+    def __init__(self, db_path="./data/sources.db", embedding_dtype='float32', id_block=1000):
+        if embedding_dtype not in DTYPES:
+            raise ValueError(f'Unknown embedding dtype {embedding_dtype}, expected one of {", ".join(DTYPES)}')
+        self.db_path = db_path
+        self.embedding_dtype = embedding_dtype
+        self.lexical = False
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.staged_lock = threading.Lock()
+        self.staged = {}
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.writer = self._connect()
+        self.reader = self._connect()
+        self.initialize_store()
+        # Ids are reserved from the database in blocks, `next_id` up to `reserved_id` are ours,
+        # then the (first, last) blocks in `spare_ids`, reserved ahead by `reserve_ahead`
+        self.id_block = id_block
+        self.next_id = 1
+        self.reserved_id = 0
+        self.spare_ids = []
+        self.reserve_lock = asyncio.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        # With WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        conn.execute('PRAGMA busy_timeout=5000;')
+        return conn
+
+    def initialize_store(self):
+        """
+        Create the sources table and its index.
+        """
+        with self.write_lock:
+            cursor = self.writer.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sources (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id INTEGER NOT NULL,
+                    title TEXT,
+                    link TEXT,
+                    text TEXT,
+                    embedding BLOB,
+                    chunk_index INTEGER DEFAULT 0,
+                    embedding_dtype TEXT NOT NULL DEFAULT 'float32'
+                )
+            ''')
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(sources)')]
+            if 'embedding_dtype' not in columns:
+                # Rows stored so far are float32
+                cursor.execute("ALTER TABLE sources ADD COLUMN embedding_dtype TEXT NOT NULL DEFAULT 'float32'")
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sources_session ON sources(session_id, id);')
+            self.writer.commit()
+            self.initialize_fts()
+
+    def initialize_fts(self):
+        """
+        Create the full-text index over titles and texts, and fill it from existing rows the first
+        time. It reads the text from `sources`, so nothing is stored twice. The session id is an
+        indexed column so searches can be limited to a session inside the index.
+        """
+        try:
+            exists = self.writer.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sources_fts'").fetchone()
+            self.writer.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS sources_fts USING fts5(
+                    session_id, title, text, content='sources', content_rowid='id', tokenize='porter unicode61'
+                )
+            ''')
+            self.writer.execute('''
+                CREATE TRIGGER IF NOT EXISTS sources_fts_insert AFTER INSERT ON sources BEGIN
+                    INSERT INTO sources_fts (rowid, session_id, title, text) VALUES (new.id, new.session_id, new.title, new.text);
+                END
+            ''')
+            self.writer.execute('''
+                CREATE TRIGGER IF NOT EXISTS sources_fts_delete AFTER DELETE ON sources BEGIN
+                    INSERT INTO sources_fts (sources_fts, rowid, session_id, title, text) VALUES ('delete', old.id, old.session_id, old.title, old.text);
+                END
+            ''')
+            if not exists:
+                self.writer.execute("INSERT INTO sources_fts (sources_fts) VALUES ('rebuild')")
+            self.writer.commit()
+            self.lexical = True
+        except sqlite3.OperationalError as e:
+            self.writer.rollback()
+            print(f'Full-text search is not available, retrieval uses vectors only: {str(e)}')
+
+    def _reserve_ids(self, count):
+        """
+        Reserve a block of row ids by advancing the AUTOINCREMENT sequence of `sources`.
+
+        SQLite never hands out an id at or below the sequence, and the sequence only grows, so a
+        reserved id is never used by another process, by an AUTOINCREMENT insert or after a
+        restart, even if the rows it was reserved for were never written.
+
+        :return: Tuple of the first and last id reserved.
+        """
+        block = max(count, self.id_block)
+        with self.write_lock:
+            try:
+                self.writer.execute('BEGIN IMMEDIATE')
+                row = self.writer.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sources'").fetchone()
+                if row is None:
+                    start = self.writer.execute('SELECT COALESCE(MAX(id), 0) FROM sources').fetchone()[0]
+                    self.writer.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('sources', ?)", (start + block,))
+                else:
+                    start = row[0]
+                    self.writer.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'sources'", (start + block,))
+                self.writer.commit()
+            except sqlite3.Error:
+                self.writer.rollback()
+                raise
+        return start + 1, start + block
+
+    def _available_ids(self):
+        return self.reserved_id - self.next_id + 1 + sum(last - first + 1 for first, last in self.spare_ids)
+
+    async def reserve_ahead(self, count):
+        """
+        Make sure `count` ids can be staged without touching the database. The next block is
+        reserved in a worker thread once fewer than half a block would be left, as the
+        reservation waits for the database write lock.
+        """
+        async with self.reserve_lock:
+            with self.staged_lock:
+                available = self._available_ids()
+            if available - count >= self.id_block // 2:
+                return
+            block = await asyncio.to_thread(self._reserve_ids, count)
+            with self.staged_lock:
+                self.spare_ids.append(block)
+
+    def stage(self, session_id, rows):
+        """
+        Assign row ids to passages and keep them in memory until `write_staged` stores them.
+
+        :param rows: List of (title, link, text, embedding, chunk_index) tuples, `embedding` a float32 array.
+
+        On the event loop, await `reserve_ahead` first, otherwise a block may be reserved here.
+
+        :return: List of the new row ids, in input order. They may span two blocks.
+        """
+        with self.staged_lock:
+            row_ids = []
+            while len(row_ids) < len(rows):
+                if self.next_id > self.reserved_id:
+                    if self.spare_ids:
+                        self.next_id, self.reserved_id = self.spare_ids.pop(0)
+                    else:
+                        self.next_id, self.reserved_id = self._reserve_ids(len(rows) - len(row_ids))
+                take = min(len(rows) - len(row_ids), self.reserved_id - self.next_id + 1)
+                row_ids.extend(range(self.next_id, self.next_id + take))
+                self.next_id += take
+            for row_id, row in zip(row_ids, rows):
+                self.staged[row_id] = (session_id, *row)
+        return row_ids
+
+    def write_staged(self, batches):
+        """
+        Commit staged rows in one transaction.
+
+        :param batches: List of row id lists returned by `stage`.
+        """
+        row_ids = [row_id for batch in batches for row_id in batch]
+        with self.staged_lock:
+            rows = [(row_id, *self.staged[row_id]) for row_id in row_ids if row_id in self.staged]
+        try:
+            with self.write_lock:
+                try:
+                    self.writer.executemany(
+                        'INSERT INTO sources (id, session_id, title, link, text, embedding, chunk_index, embedding_dtype) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(row_id, session_id, title, link, text, encode(embedding, self.embedding_dtype), chunk_index, self.embedding_dtype)
+                         for row_id, session_id, title, link, text, embedding, chunk_index in rows]
+                    )
+                    self.writer.commit()
+                except sqlite3.Error:
+                    self.writer.rollback()
+                    raise
+        finally:
+            # Rows that failed to write are dropped too, reads then skip their ids and their
+            # writer removes them from the vector indexes
+            with self.staged_lock:
+                for row_id in row_ids:
+                    self.staged.pop(row_id, None)
+
+    def insert(self, session_id, rows):
+        """
+        Insert passages for a session in one transaction.
+
+        :param rows: List of (title, link, text, embedding, chunk_index) tuples, `embedding` a float32 array.
+
+        :return: List of the new row ids, in input order.
+        """
+        row_ids = self.stage(session_id, rows)
+        self.write_staged([row_ids])
+        return row_ids
+
+    def _staged_rows(self, session_id=None, after_id=0):
+        with self.staged_lock:
+            return [(row_id, row) for row_id, row in self.staged.items()
+                    if row_id > after_id and (session_id is None or row[0] == session_id)]
+
+    def _read(self, sql, params=()):
+        with self.read_lock:
+            return self.reader.execute(sql, params).fetchall()
+
+    def load_vectors(self, session_id=None, after_id=0, dim=None):
+        """
+        Read ids and embeddings of rows newer than `after_id`, for one session or for all of them.
+
+        Rows without an embedding (migrated, not yet re-embedded) are skipped, and so are rows whose
+        embedding is not `dim` long, by default the most common length.
+
+        :return: Tuple of (ids, vectors), vectors being None when there are no rows.
+        """
+        # Staged rows are read first, a row written in between is then found by the query
+        staged = self._staged_rows(session_id, after_id)
+        if session_id is None:
+            rows = self._read('SELECT id, embedding, embedding_dtype FROM sources WHERE id > ? ORDER BY id', (after_id,))
+        else:
+            rows = self._read('SELECT id, embedding, embedding_dtype FROM sources WHERE session_id = ? AND id > ? ORDER BY id', (session_id, after_id))
+        vectors = [(row[0], decode(row[1], row[2])) for row in rows if row[1] is not None]
+        written = {row[0] for row in rows}
+        vectors += [(row_id, row[4]) for row_id, row in staged if row_id not in written]
+        if not vectors:
+            return [], None
+        vectors.sort(key=lambda row: row[0])
+        dim = dim or Counter(len(row[1]) for row in vectors).most_common(1)[0][0]
+        kept = [row for row in vectors if len(row[1]) == dim]
+        if len(kept) < len(vectors):
+            print(f'Skipped {len(vectors) - len(kept)} embeddings that are not {dim} long')
+        if not kept:
+            return [], None
+        return [row[0] for row in kept], np.stack([row[1] for row in kept])
+
+    def unembedded_rows(self, limit=256):
+        """
+        Rows stored without an embedding, e.g. by `migrate_legacy_tables`, oldest first.
+
+        :return: List of (row id, session id, text) tuples.
+        """
+        return self._read(
+            "SELECT id, session_id, text FROM sources WHERE embedding IS NULL AND COALESCE(text, '') != '' ORDER BY id LIMIT ?", (limit,)
+        )
+
+    def set_embeddings(self, rows):
+        """
+        Store embeddings of existing rows in one transaction.
+
+        :param rows: List of (row id, embedding) tuples, `embedding` a float32 array.
+        """
+        with self.write_lock:
+            try:
+                self.writer.executemany(
+                    'UPDATE sources SET embedding = ?, embedding_dtype = ? WHERE id = ?',
+                    [(encode(embedding, self.embedding_dtype), self.embedding_dtype, row_id) for row_id, embedding in rows]
+                )
+                self.writer.commit()
+            except sqlite3.Error:
+                self.writer.rollback()
+                raise
+
+    def fetch_rows(self, row_ids):
+        """
+        Read passages by id.
+
+        :return: Dictionary of row id to a dictionary with 'title', 'link', 'text' and 'chunk_index'.
+        """
+        found = {}
+        with self.staged_lock:
+            for row_id in row_ids:
+                row = self.staged.get(row_id)
+                if row is not None:
+                    found[row_id] = {'title': row[1], 'link': row[2], 'text': row[3], 'chunk_index': row[5]}
+        row_ids = [row_id for row_id in row_ids if row_id not in found]
+        for start in range(0, len(row_ids), 500):
+            chunk = row_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in self._read(f'SELECT id, title, link, text, chunk_index FROM sources WHERE id IN ({placeholders})', chunk):
+                found[row[0]] = {'title': row[1], 'link': row[2], 'text': row[3], 'chunk_index': row[4]}
+        return found
+
+    def search_text(self, query, session_id=None, limit=50):
+        """
+        BM25 search of committed rows, for one session or for all of them. Rows match when they
+        contain any of the query's terms; rows containing more and rarer terms rank higher.
+
+        :return: List of (row id, score) tuples, best first. Scores are positive, higher is better.
+        """
+        terms = query_terms(query)
+        if not self.lexical or not terms:
+            return []
+        expression = ' OR '.join(f'"{term}"' for term in terms)
+        if session_id is not None:
+            expression = f'session_id : "{int(session_id)}" AND ({expression})'
+        try:
+            # The session id column gets no weight, titles count double
+            rows = self._read(
+                'SELECT rowid, bm25(sources_fts, 0.0, 2.0, 1.0) AS score FROM sources_fts WHERE sources_fts MATCH ? ORDER BY score LIMIT ?',
+                (expression, limit)
+            )
+        except sqlite3.OperationalError as e:
+            print(f'Full-text search failed: {str(e)}')
+            return []
+        return [(row[0], -row[1]) for row in rows]
+
+    def iter_session(self, session_id, batch_size=500):
+        """
+        Yield the passages of a session in insertion order, reading `batch_size` rows at a time.
+        """
+        last_id = 0
+        while True:
+            rows = self._read(
+                'SELECT id, title, link, text, embedding, embedding_dtype FROM sources WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (session_id, last_id, batch_size)
+            )
+            if not rows:
+                return
+            for row in rows:
+                yield {'title': row[1], 'link': row[2], 'text': row[3], 'embedding': decode(row[4], row[5]) if row[4] is not None else None}
+            last_id = rows[-1][0]
+
+    def migrate_legacy_tables(self):
+        """
+        Move rows out of the per-session `sources_{session_id}` tables into `sources` and drop
+        them. Each table is copied in its own transaction, so an interrupted migration resumes
+        where it stopped.
+
+        Only titles, links and texts are copied. The old tables hold one float per row instead of
+        an embedding, so migrated rows have none until tools.source_manager.backfill_embeddings
+        re-embeds them.
+
+        :return: List of the migrated session ids. Their rows have new ids, so any vector index
+                 saved for these sessions is out of date.
+        """
+        migrated = []
+        with self.write_lock:
+            tables = [row[0] for row in self.writer.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\'", (LEGACY_TABLE_PATTERN,)
+            )]
+            for table in tables:
+                suffix = table.split('_', 1)[1]
+                if not suffix.isdigit():
+                    continue
+                columns = [row[1] for row in self.writer.execute(f'PRAGMA table_info({table})')]
+                chunk_index = 'COALESCE(chunk_index, 0)' if 'chunk_index' in columns else '0'
+                try:
+                    self.writer.execute('BEGIN')
+                    self.writer.execute(f'''
+                        INSERT INTO sources (session_id, title, link, text, embedding, chunk_index)
+                        SELECT ?, title, link, text, NULL, {chunk_index} FROM {table} ORDER BY id
+                    ''', (int(suffix),))
+                    self.writer.execute(f'DROP TABLE {table}')
+                    self.writer.commit()
+                except sqlite3.Error as e:
+                    self.writer.rollback()
+                    print(f'Failed to migrate {table}: {str(e)}')
+                    continue
+                migrated.append(int(suffix))
+        if migrated:
+            print(f'Migrated {len(migrated)} legacy source tables')
+        return migrated
+
+    def close(self):
+        with self.write_lock, self.read_lock:
+            self.writer.close()
+            self.reader.close()
+
+
+_shared_store = None
+
+
+def shared_source_store():
+    """
+    Store shared by every Sources instance so connections are opened once per process. It is
+    opened on first use, importing this module does not create the database.
+    """
+    global _shared_store
+    if _shared_store is None:
+        _shared_store = SourceStore(embedding_dtype=os.getenv('EMBEDDING_DTYPE', 'float32'))
+    return _shared_store
@@ -1,34 +1,20 @@
 import asyncio
-import fitz  # PyMuPDF
 from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
+from tools.browser_pool import BrowserPool
+from tools.http_client import HttpClient, MAX_PDF_BYTES
+from tools.content_cache import ContentCache
+from tools.html_extraction import ExtractionPool
+from tools.domain_guard import DomainGuard, domain_of
+from tools.pdf_extraction import PdfExtractionError, extract_text_from_pdf  # Re-exported, it used to live here
+from tools.metrics import FETCH_SECONDS, TIER_SECONDS, FETCHED_BYTES, BLOCKED_REQUESTS, PAGES, timed
 from asyncio import Semaphore
 import re
-import aiohttp
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
-async def fetch_pdf(url):
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    pdf_buffer = await response.read()
-                    return pdf_buffer
-                else:
-                    return f"Failed to fetch PDF: HTTP Status {response.status}"
-    except Exception as e:
-        return f"Error fetching PDF: {str(e)}"
-
-def extract_text_from_pdf(pdf_buffer, max_content=5000):
-    try:
-        # Open the PDF using bytes
-        pdf_document = fitz.open(stream=pdf_buffer, filetype="pdf")
-        text = ""
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            text += page.get_text()
-        return text[:max_content]
-    except Exception as e:
-        return f"Error extracting text from PDF: {str(e)}"
+# Documents are kept whole up to this size and split into passages before embedding
+MAX_DOCUMENT_CHARS = 20000
 
 def clean_text(text):
     try:
@@ -56,76 +42,362 @@ def extract_main_content(html, max_content=3000):
     except Exception as e:
         return f"Error extracting main content from HTML: {str(e)}"
 
-async def process_url(url, context, semaphore, retries=1, timeout=10):
-    async with semaphore:
+# Texts returned by bot walls and failed fetches, never worth embedding
+BLOCKED_CONTENT = ['Error fetching content.', 'Enable JavaScript and cookies to continue', 'Please enable JS and disable any ad blocker', 'Access Denied']
+JS_GATE_MARKERS = ['enable javascript', 'enable js', 'javascript is disabled', 'javascript is required', 'checking your browser', 'just a moment', 'access denied']
+
+def looks_js_gated(text, min_length=200):
+    """
+    Guess whether text extracted from raw HTML needs a real browser to render.
+    """
+    if not text or text in BLOCKED_CONTENT or len(text) < min_length:
+        return True
+    # Gate pages are short, so only look for markers in short texts
+    lowered = text[:1500].lower()
+    return len(text) < 1500 and any(marker in lowered for marker in JS_GATE_MARKERS)
+
+# Resource types a text-only page load never needs; documents, scripts and XHR still load
+BLOCKED_RESOURCE_TYPES = frozenset(['image', 'media', 'font', 'stylesheet', 'texttrack', 'manifest', 'imageset', 'beacon', 'csp_report', 'ping'])
+# Ad, tracking and analytics hosts, blocked together with their subdomains
+BLOCKED_HOSTS = frozenset([
+    'doubleclick.net', 'googlesyndication.com', 'googleadservices.com', 'google-analytics.com',
+    'googletagmanager.com', 'googletagservices.com', 'adservice.google.com', 'amazon-adsystem.com',
+    'adnxs.com', 'adsrvr.org', 'criteo.com', 'criteo.net', 'taboola.com', 'outbrain.com',
+    'scorecardresearch.com', 'quantserve.com', 'moatads.com', 'pubmatic.com', 'rubiconproject.com',
+    'casalemedia.com', 'openx.net', 'chartbeat.com', 'chartbeat.net', 'hotjar.com', 'segment.io',
+    'segment.com', 'mixpanel.com', 'newrelic.com', 'nr-data.net', 'optimizely.com', 'facebook.net',
+    'connect.facebook.net', 'ads-twitter.com', 'bat.bing.com', 'clarity.ms', 'branch.io', 'onetrust.com',
+    'cookielaw.org', 'trustarc.com', 'quantcast.com', 'sharethrough.com', 'teads.tv', 'yieldmo.com'
+])
+
+def host_matches(host, domains):
+    """
+    Whether `host` is one of `domains` or a subdomain of one.
+    """
+    host = host.lower()
+    while host:
+        if host in domains:
+            return True
+        dot = host.find('.')
+        if dot < 0:
+            return False
+        host = host[dot + 1:]
+    return False
+
+class PageTraffic:
+    """
+    Requests a browser page made while loading one URL, for reporting bytes transferred.
+    """
+    def __init__(self):
+        self.finished = []
+        self.blocked = 0
+        self.route = None
+
+    def on_finished(self, request):
+        self.finished.append(request)
+
+    async def transferred_bytes(self):
+        sizes = await asyncio.gather(*(request.sizes() for request in self.finished), return_exceptions=True)
+        return sum(size['responseBodySize'] + size['responseHeadersSize'] for size in sizes if isinstance(size, dict))
+
+class ResourcePolicy:
+    """
+    Request interception for browser page loads.
+
+    Requests for `blocked_types` resources (images, fonts, stylesheets, media, ...) and for ad or
+    analytics hosts are aborted before Chromium downloads them. `overrides` maps a site's domain
+    to resource types it needs anyway, e.g. {'example.com': {'stylesheet'}}, or to '*' to turn
+    blocking off for that site.
+    """
+    def __init__(self, blocked_types=BLOCKED_RESOURCE_TYPES, blocked_hosts=BLOCKED_HOSTS, overrides=None):
+        self.blocked_types = frozenset(blocked_types)
+        self.blocked_hosts = frozenset(blocked_hosts)
+        self.overrides = overrides or {}
+
+    def rules_for(self, url):
+        """
+        :return: Tuple of (blocked resource types, blocked hosts) for pages of `url`'s site.
+        """
+        host = urlsplit(url).hostname or ''
+        for domain, allowed in self.overrides.items():
+            if host_matches(host, {domain}):
+                if allowed == '*':
+                    return frozenset(), frozenset()
+                return self.blocked_types - frozenset(allowed), self.blocked_hosts
+        return self.blocked_types, self.blocked_hosts
+
+    async def attach(self, page, url):
+        """
+        Start intercepting the requests of `page` for a load of `url`.
+
+        :return: PageTraffic recording the page's requests, to pass to `detach`.
+        """
+        traffic = PageTraffic()
+        blocked_types, blocked_hosts = self.rules_for(url)
+
+        async def route(route):
+            request = route.request
+            if request.resource_type in blocked_types or host_matches(urlsplit(request.url).hostname or '', blocked_hosts):
+                traffic.blocked += 1
+                await route.abort('blockedbyclient')
+            else:
+                await route.continue_()
+
+        traffic.route = route
+        await page.route('**/*', route)
+        page.on('requestfinished', traffic.on_finished)
+        return traffic
+
+    async def detach(self, page, traffic):
+        """
+        Stop intercepting, so the pooled page is handed back without handlers.
+        """
+        page.remove_listener('requestfinished', traffic.on_finished)
         try:
-            page = await context.new_page()
-        except Exception as e:
-            return f"Failed to open a new page for {url}: {str(e)}"
+            await page.unroute('**/*', traffic.route)
+        except Exception:
+            pass
 
-        for attempt in range(retries):
-            try:
-                return await asyncio.wait_for(
-                    process_url_inner(url, page),
-                    timeout=timeout
-                )
-            except asyncio.TimeoutError:
-                await page.close()
-                return f"Timeout reached for {url} after {timeout} seconds"
-            except Exception as e:
-                if attempt < retries - 1:
-                    await asyncio.sleep(0.5)
-                else:
-                    await page.close()
-                    return f"Failed to fetch {url} after {retries} attempts: {str(e)}"
+class Scraper:
+    """
+    Tiered page fetcher shared across requests.
+
+    Pages are first looked up in the optional cross-session content cache, then fetched with a
+    plain GET over the shared HTTP session and only sent to the headless browser pool when the
+    extracted text looks JS-gated or too short. Text is extracted from HTML in a process pool.
+    Browser page loads skip resources a text extraction does not need, see ResourcePolicy, and
+    domains that keep failing are limited by a shared DomainGuard.
+    """
+    def __init__(self, browser_pool: BrowserPool = None, http_client: HttpClient = None, cache: ContentCache = None, extractor: ExtractionPool = None, resource_policy: ResourcePolicy = None, domain_guard: DomainGuard = None):
+        self.browser_pool = browser_pool or BrowserPool()
+        self.http_client = http_client or HttpClient()
+        self.cache = cache
+        self.extractor = extractor or ExtractionPool()
+        self.resource_policy = resource_policy or ResourcePolicy()
+        self.domain_guard = domain_guard or DomainGuard()
+
+    async def start(self, warm_browsers=True):
+        await self.http_client.start()
+        await self.extractor.start()
+        if warm_browsers:
+            await self.browser_pool.start()
+
+    async def stop(self):
+        await self.http_client.stop()
+        await self.browser_pool.stop()
+        await self.extractor.stop()
+
+    async def process_urls(self, urls, concurrency=10, timeout=10):
+        """
+        Scrape the given URLs concurrently.
+
+        :return: List of dictionaries with 'text' and the 'tier' that served each URL, aligned with `urls`.
+        """
+        semaphore = Semaphore(concurrency)
+        tasks = [process_url(url, self, semaphore, timeout=timeout) for url in urls]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        results = [{'text': str(result), 'tier': 'error'} if isinstance(result, BaseException) else result for result in results]
+
+        tiers = {}
+        for result in results:
+            tiers[result['tier']] = tiers.get(result['tier'], 0) + 1
+        print(f"Pages served by tier: {', '.join(f'{tier}={count}' for tier, count in sorted(tiers.items()))}")
+        return results
+
+    async def iter_urls(self, urls, concurrency=10, timeout=10, deadline=None):
+        """
+        Scrape the given URLs concurrently and yield results as soon as they are ready.
 
-async def process_url_inner(url, page):
-    # Check if the URL ends with .pdf or contains /pdf/ in the path
-    if url.lower().endswith('.pdf') or '/pdf/' in url.lower():
+        Each iteration yields a list of (index, result) pairs for the pages that finished together.
+        Iteration stops at `deadline` (a time.monotonic() value); pages still in flight when the
+        deadline passes or when the caller stops iterating are cancelled.
+        """
+        semaphore = Semaphore(concurrency)
+        tasks = {asyncio.create_task(process_url(url, self, semaphore, timeout=timeout)): i for i, url in enumerate(urls)}
+        pending = set(tasks)
         try:
-            # Close the page as we'll fetch the PDF directly using aiohttp
-            await page.close()
-            pdf_buffer = await fetch_pdf(url)
-            if isinstance(pdf_buffer, str):  # Check if there was an error fetching the PDF
-                return pdf_buffer
-            pdf_text = extract_text_from_pdf(pdf_buffer)
-            return pdf_text
-        except Exception as e:
-            return f"Error processing PDF at {url}: {str(e)}"
-
-    # If it's not a PDF, proceed with HTML content processing
-    await page.goto(url, wait_until='domcontentloaded')
-    try:
-        content = await page.content()
-        cleaned_content = clean_text(extract_main_content(content))
-        await page.close()
-        return cleaned_content
-    except Exception as e:
-        await page.close()
-        return f"Error processing HTML content at {url}: {str(e)}"
+            while pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    yield [(tasks[task], task.result()) for task in done]
+        finally:
+            for task in pending:
+                task.cancel()
+
+async def process_url(url, scraper, semaphore, retries=1, timeout=10):
+    """
+    Scrape one URL, recording how long it took and which tier served it.
+
+    :return: Dictionary with 'text' and 'tier'.
+    """
+    start = time.perf_counter()
+    result = await _process_url(url, scraper, semaphore, retries, timeout)
+    FETCH_SECONDS.observe(time.perf_counter() - start, tier=result['tier'])
+    PAGES.inc(tier=result['tier'])
+    return result
+
+async def _process_url(url, scraper, semaphore, retries, timeout):
+    cache = scraper.cache
+    cached = await cache.lookup(url) if cache is not None else None
+    if cached is not None and cached['fresh']:
+        return {'text': cached['text'], 'tier': 'cache'}
+
+    # Domains that keep failing are skipped or get a shorter timeout
+    guard = scraper.domain_guard
+    allowed, timeout = guard.admit(url, timeout)
+    if not allowed:
+        return {'text': f"Skipped {url}: {domain_of(url)} has been failing", 'tier': 'error'}
 
-async def process_urls_async(urls, concurrency=10, timeout=10):
-    semaphore = Semaphore(concurrency)
-    async with async_playwright() as playwright:
+    async with guard.slot(url), semaphore:
         try:
-            browser = await playwright.chromium.launch(
-                headless=True,
-                args=["--disable-gpu", "--no-sandbox", "--disable-dev-shm-usage"]
-            )
-            context = await browser.new_context(user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-        except Exception as e:
-            return [f"Failed to launch browser or create context: {str(e)}"]
-
-        tasks = [process_url(url, context, semaphore, timeout=timeout) for url in urls]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+            for attempt in range(retries):
+                try:
+                    result = await asyncio.wait_for(
+                        process_url_inner(url, scraper, cached),
+                        timeout=timeout
+                    )
+                except asyncio.TimeoutError:
+                    guard.record_failure(url, 'timeout')
+                    return {'text': f"Timeout reached for {url} after {timeout} seconds", 'tier': 'error'}
+                except Exception as e:
+                    if attempt < retries - 1:
+                        await asyncio.sleep(0.5)
+                        continue
+                    guard.record_failure(url, 'error')
+                    return {'text': f"Failed to fetch {url} after {retries} attempts: {str(e)}", 'tier': 'error'}
+
+                if result['tier'] == 'error':
+                    guard.record_failure(url, 'error')
+                elif result['tier'] == 'browser' and looks_js_gated(result['text']):
+                    guard.record_failure(url, 'js_wall')
+                else:
+                    guard.record_success(url)
+                return result
+        except asyncio.CancelledError:
+            guard.abandon(url)
+            raise
 
-        await context.close()
-        await browser.close()
+def conditional_headers(cached):
+    headers = {}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    return headers
 
-        return results
+async def fetch_with_http(url, http_client, extractor, cached=None):
+    """
+    Plain HTTP tier, sent as a conditional GET when a stale cache entry is available. PDFs,
+    recognised from the response, are extracted here too.
+
+    :return: Tuple of (status, text, headers, kind). `kind` is 'html', 'pdf' or None; `text` is
+             None when the page has to go to the browser.
+
+    :raises PdfExtractionError: If the response is a PDF over the size cap or one that cannot be read.
+    """
+    try:
+        with timed(TIER_SECONDS, tier='http'):
+            status, headers, kind, body = await http_client.fetch_document(url, headers=conditional_headers(cached))
+    except Exception:
+        return None, None, {}, None
+    if kind == 'pdf':
+        if body is None:
+            raise PdfExtractionError(f"Skipped PDF at {url}: larger than {MAX_PDF_BYTES} bytes")
+        return status, await extractor.extract_pdf(body, max_content=MAX_DOCUMENT_CHARS), headers, kind
+    if kind != 'html':
+        return status, None, headers, kind
+    return status, await extractor.extract(body, max_content=MAX_DOCUMENT_CHARS), headers, kind
+
+async def fetch_with_browser(url, browser_pool, extractor, policy=None):
+    """
+    Headless browser tier, run on a pooled page. Requests blocked by `policy` are never downloaded.
+
+    :return: Tuple of (text, headers, transferred bytes).
+    """
+    with timed(TIER_SECONDS, tier='browser'):
+        async with browser_pool.page() as page:
+            traffic = await policy.attach(page, url) if policy is not None else None
+            try:
+                response = await page.goto(url, wait_until='domcontentloaded')
+                content = await page.content()
+            finally:
+                if traffic is not None:
+                    await policy.detach(page, traffic)
+            headers = response.headers if response is not None else {}
+            transferred = await traffic.transferred_bytes() if traffic is not None else None
+    if transferred is not None:
+        FETCHED_BYTES.inc(transferred, tier='browser')
+        BLOCKED_REQUESTS.inc(traffic.blocked)
+    return await extractor.extract(content, max_content=MAX_DOCUMENT_CHARS), headers, transferred
+
+async def process_url_inner(url, scraper, cached=None):
+    """
+    Fetch a URL that is not fresh in the cache. A stale `cached` entry is revalidated.
+    """
+    cache = scraper.cache
+
+    # Static pages and PDFs are served by a plain GET, the browser is only used for JS-gated pages
+    try:
+        status, text, headers, kind = await fetch_with_http(url, scraper.http_client, scraper.extractor, cached)
+    except PdfExtractionError as e:
+        return {'text': str(e), 'tier': 'error'}
+    if status == 304 and cached is not None:
+        cache.revalidate(url)
+        return {'text': cached['text'], 'tier': 'cache'}
+
+    if kind == 'pdf':
+        if cache is not None and text:
+            cache.store(url, text, 'pdf', headers.get('etag'), headers.get('last-modified'))
+        return {'text': text, 'tier': 'pdf'}
+
+    if text is not None and not looks_js_gated(text):
+        tier = 'http'
+    else:
+        text, headers, transferred = await fetch_with_browser(url, scraper.browser_pool, scraper.extractor, scraper.resource_policy)
+        tier = 'browser'
+
+    if cache is not None and not looks_js_gated(text):
+        cache.store(url, text, tier, headers.get('etag'), headers.get('last-modified'))
+    if tier == 'browser':
+        return {'text': text, 'tier': tier, 'bytes': transferred}
+    return {'text': text, 'tier': tier}
+
+@asynccontextmanager
+async def scraper_session(scraper=None, concurrency=10):
+    """
+    Yield the shared scraper, or a temporary one that is started and stopped around the block.
+    """
+    if scraper is not None:
+        yield scraper
+        return
+
+    # Browsers are launched lazily, only if a page actually needs one
+    scraper = Scraper(BrowserPool(size=1, pages_per_browser=concurrency))
+    await scraper.start(warm_browsers=False)
+    try:
+        yield scraper
+    finally:
+        await scraper.stop()
+
+async def process_urls_async(urls, scraper=None, concurrency=10, timeout=10):
+    """
+    Scrape the given URLs concurrently.
+
+    :param urls: List of URLs to scrape.
+    :param scraper: Shared Scraper. A temporary one is started and stopped when omitted.
+    :param concurrency: Maximum number of URLs processed at once for this call.
+    :param timeout: Per-URL timeout in seconds.
+
+    :return: List of dictionaries with 'text' and 'tier', aligned with `urls`.
+    """
+    async with scraper_session(scraper, concurrency) as active_scraper:
+        return await active_scraper.process_urls(urls, concurrency=concurrency, timeout=timeout)
 
 if __name__ == "__main__":
-    import time
     urls = [
         'https://www.imdb.com/list/ls033398199/',
         'https://www.imdb.com/list/ls064849128/',
@@ -140,7 +412,7 @@ if __name__ == "__main__":
     content_list = asyncio.run(process_urls_async(urls))
     end_time = time.time()
     for i, content in enumerate(content_list):
-        print(f"Content from URL {urls[i]}:\n")
-        print(content)
+        print(f"Content from URL {urls[i]} ({content['tier']}):\n")
+        print(content['text'])
         print("\n" + "="*80 + "\n")
     print(f'Time taken: {end_time-start_time:.4f}s')
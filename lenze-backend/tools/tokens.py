@@ -0,0 +1,62 @@
+import threading
+
+__all__ = ["TokenCounter", "token_counter"]
+
+
+class TokenCounter:
+    """
+    Count and cut text in model tokens with tiktoken.
+
+    The encoding is loaded on first use, or ahead of time with `load`. tiktoken downloads it once
+    and caches it; where that is not possible (no tiktoken, no network) counting falls back to
+    an estimate of `chars_per_token` characters per token, so budgets still hold roughly.
+    """
+    def __init__(self, model="gpt-4o-mini", chars_per_token=4):
+        self.model = model
+        self.chars_per_token = chars_per_token
+        self.encoding = None
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the model's encoding. Blocking, call it from a thread at startup.
+        """
+        if self.encoding is not None or self.disabled:
+            return self.encoding
+        with self.lock:
+            if self.encoding is None and not self.disabled:
+                try:
+                    import tiktoken
+                    try:
+                        self.encoding = tiktoken.encoding_for_model(self.model)
+                    except KeyError:
+                        self.encoding = tiktoken.get_encoding('o200k_base')
+                except Exception as e:
+                    self.disabled = True
+                    print(f'Failed to load the tokenizer, estimating token counts instead: {str(e)}')
+        return self.encoding
+
+    def count(self, text):
+        encoding = self.load()
+        if encoding is None:
+            return -(-len(text) // self.chars_per_token)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, limit):
+        """
+        Cut `text` to at most `limit` tokens.
+        """
+        if limit <= 0:
+            return ''
+        encoding = self.load()
+        if encoding is None:
+            return text[:limit * self.chars_per_token]
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= limit:
+            return text
+        return encoding.decode(tokens[:limit])
+
+
+# Shared so the encoding is loaded once per process
+token_counter = TokenCounter()
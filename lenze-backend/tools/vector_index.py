@@ -0,0 +1,253 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from tools.quantization import quantize, dequantize, scores as dot_scores
+
+__all__ = ["VectorIndex", "IndexRegistry", "index_registry"]
+
+
+class VectorIndex:
+    """
+    In-memory matrix of L2-normalised vectors with their row ids.
+
+    Vectors are normalised once when added, so cosine similarity against a query is a single
+    matrix-vector product. Rows live in one contiguous array that grows by doubling, and top-k
+    selection uses argpartition instead of a full sort.
+
+    With `dtype` 'int8' vectors are kept as int8 codes with a scale per row, a quarter of the
+    index's memory, and scored without widening the whole matrix.
+    """
+    def __init__(self, dim=None, capacity=64, dtype='float32'):
+        self.dim = dim
+        self.capacity = capacity
+        self.dtype = dtype
+        self.size = 0
+        self.vectors = None
+        self.scales = None
+        self.ids = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def max_id(self):
+        return int(self.ids[self.size - 1]) if self.size else 0
+
+    def _ensure_capacity(self, extra):
+        needed = self.size + extra
+        if self.vectors is not None and needed <= len(self.vectors) and self.vectors.flags.writeable:
+            return
+        capacity = max(self.capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        vectors = np.empty((capacity, self.dim), dtype=self.dtype)
+        scales = np.empty(capacity, dtype=np.float32) if self.dtype == 'int8' else None
+        ids = np.empty(capacity, dtype=np.int64)
+        if self.size:
+            vectors[:self.size] = self.vectors[:self.size]
+            ids[:self.size] = self.ids[:self.size]
+            if scales is not None:
+                scales[:self.size] = self.scales[:self.size]
+        self.vectors, self.scales, self.ids, self.capacity = vectors, scales, ids, capacity
+
+    def add(self, ids, vectors):
+        """
+        Append vectors and their row ids.
+        """
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        codes, scales = quantize(vectors / norms, self.dtype)
+        self._ensure_capacity(len(ids))
+        self.vectors[self.size:self.size + len(ids)] = codes
+        if scales is not None:
+            self.scales[self.size:self.size + len(ids)] = scales
+        self.ids[self.size:self.size + len(ids)] = ids
+        self.size += len(ids)
+
+    def remove(self, ids):
+        """
+        Drop rows by id, e.g. rows whose write to the database failed.
+        """
+        if not self.size or len(ids) == 0:
+            return
+        keep = ~np.isin(self.ids[:self.size], np.asarray(ids, dtype=np.int64))
+        if keep.all():
+            return
+        # Boolean indexing copies, which also detaches memory-mapped vectors
+        self.vectors = self.vectors[:self.size][keep]
+        self.scales = self.scales[:self.size][keep] if self.scales is not None else None
+        self.ids = self.ids[:self.size][keep]
+        self.size = self.capacity = len(self.ids)
+
+    def search(self, query, top_k=5, threshold=None, last=None):
+        """
+        Find the rows most similar to a query vector.
+
+        :param query: Query vector.
+        :param top_k: Maximum number of results.
+        :param threshold: Only return rows with a cosine similarity above this value.
+        :param last: Only search the `last` most recently added rows.
+
+        :return: List of (row id, similarity) tuples, most similar first.
+        """
+        if self.size == 0:
+            return []
+        start = max(0, self.size - last) if last else 0
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scales = self.scales[start:self.size] if self.scales is not None else None
+        scores = dot_scores(self.vectors[start:self.size], scales, query)
+
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        if threshold is not None:
+            best = best[scores[best] > threshold]
+        return [(int(self.ids[start + i]), float(scores[i])) for i in best]
+
+    def score_ids(self, query, ids):
+        """
+        Cosine similarity of a query vector to the given rows. Rows are added in id order, so
+        they are found by binary search.
+
+        :return: Dictionary of row id to similarity, for the ids present in the index.
+        """
+        if self.size == 0 or not len(ids):
+            return {}
+        ids = np.asarray(ids, dtype=np.int64)
+        indexed = self.ids[:self.size]
+        positions = np.minimum(np.searchsorted(indexed, ids), self.size - 1)
+        found = indexed[positions] == ids
+        positions, ids = positions[found], ids[found]
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = dot_scores(self.vectors[positions], self.scales[positions] if self.scales is not None else None, query)
+        return {int(row_id): float(score) for row_id, score in zip(ids, scores)}
+
+    def save(self, path):
+        np.save(f'{path}.vectors.npy', self.vectors[:self.size])
+        np.save(f'{path}.ids.npy', self.ids[:self.size])
+        if self.scales is not None:
+            np.save(f'{path}.scales.npy', self.scales[:self.size])
+        elif os.path.exists(f'{path}.scales.npy'):
+            os.remove(f'{path}.scales.npy')
+
+    @classmethod
+    def load(cls, path, mmap=True, dtype=None):
+        """
+        Load a saved index. With `mmap` the vectors stay on disk until the first add.
+
+        :param dtype: Form to keep the vectors in. An index saved in another form is converted
+                      (and then read into memory); by default it is kept as saved.
+        """
+        vectors = np.load(f'{path}.vectors.npy', mmap_mode='r' if mmap else None)
+        ids = np.load(f'{path}.ids.npy')
+        scales = np.load(f'{path}.scales.npy') if vectors.dtype == np.int8 else None
+        saved = str(vectors.dtype)
+        index = cls(dim=vectors.shape[1] if vectors.ndim == 2 else None, dtype=saved)
+        if dtype is not None and dtype != saved and len(ids):
+            vectors, scales = quantize(dequantize(vectors, scales), dtype)
+        index.dtype = dtype or saved
+        index.vectors, index.scales, index.ids, index.size = vectors, scales, ids, len(ids)
+        index.capacity = max(index.capacity, len(ids))
+        return index
+
+    def nbytes(self):
+        """
+        Memory taken by the stored rows.
+        """
+        if self.size == 0:
+            return 0
+        total = self.vectors[:self.size].nbytes + self.ids[:self.size].nbytes
+        return total + (self.scales[:self.size].nbytes if self.scales is not None else 0)
+
+
+class IndexRegistry:
+    """
+    Keeps the most recently used indexes in memory.
+
+    Indexes are built on first use through a loader, saved to `directory` when evicted or on
+    shutdown, and memory-mapped back from disk next time; the loader then only has to supply
+    rows added after the saved ones.
+
+    :param dtype: Form vectors are kept in, 'float32' or 'int8'.
+    """
+    def __init__(self, directory="./data/indexes", max_indexes=256, mmap=True, dtype='float32'):
+        self.directory = directory
+        self.max_indexes = max_indexes
+        self.mmap = mmap
+        self.dtype = dtype
+        self.indexes = OrderedDict()
+        self.unsaved = set()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def peek(self, name):
+        return self.indexes.get(name)
+
+    def get(self, name, loader, persist=True):
+        """
+        Return the named index, building it if needed.
+
+        :param loader: Callable taking the last row id already indexed and the index's dimension (None
+                       while it is empty), and returning (ids, vectors) for newer rows.
+        :param persist: Whether the index is saved to disk when evicted.
+        """
+        if name in self.indexes:
+            self.indexes.move_to_end(name)
+            return self.indexes[name]
+
+        index = None
+        if persist and self.directory and os.path.exists(f'{self._path(name)}.ids.npy'):
+            try:
+                index = VectorIndex.load(self._path(name), mmap=self.mmap, dtype=self.dtype)
+            except Exception as e:
+                print(f'Failed to load index {name}: {str(e)}')
+        if index is None:
+            index = VectorIndex(dtype=self.dtype)
+
+        ids, vectors = loader(index.max_id, index.dim)
+        index.add(ids, vectors)
+        if persist and len(ids):
+            self.unsaved.add(name)
+
+        self.indexes[name] = index
+        if len(self.indexes) > self.max_indexes:
+            evicted, evicted_index = self.indexes.popitem(last=False)
+            self._save(evicted, evicted_index)
+        return index
+
+    def drop(self, name):
+        """
+        Forget an index, in memory and on disk, so it is rebuilt from its loader next time.
+        """
+        self.indexes.pop(name, None)
+        self.unsaved.discard(name)
+        for suffix in ('vectors', 'ids', 'scales'):
+            path = f'{self._path(name)}.{suffix}.npy'
+            if self.directory and os.path.exists(path):
+                os.remove(path)
+
+    def mark_dirty(self, name):
+        self.unsaved.add(name)
+
+    def _save(self, name, index):
+        if name not in self.unsaved or not self.directory or len(index) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        index.save(self._path(name))
+        self.unsaved.discard(name)
+
+    def save_all(self):
+        for name, index in self.indexes.items():
+            self._save(name, index)
+
+
+# Shared by every Sources instance so indexes outlive a single request
+index_registry = IndexRegistry(dtype=os.getenv('EMBEDDING_DTYPE', 'float32'))
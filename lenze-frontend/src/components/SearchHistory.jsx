@@ -1,24 +1,28 @@
-import React, { useEffect, useState } from 'react';
+import React, { useCallback, useEffect, useState } from 'react';
 import axios from 'axios';
 import { useNavigate } from 'react-router-dom'
 import './SearchHistory.css';const API_URL = 'http://localhost:8000';
 
 const SearchHistory = () => {
     const [history, setHistory] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null); // Set while older sessions remain
     const navigate = useNavigate(); // useNavigate hook from react-router-dom
 
-    useEffect(() => {
-        const fetchHistory = async () => {
-            try {
-                const response = await axios.get(`${API_URL}/search-history`);
-                setHistory(response.data);
-            } catch (error) {
-                console.error('Error fetching search history:', error);
-            }
-        };
+    // Sessions come newest first, one page at a time; `before` continues after the last page
+    const fetchHistory = useCallback(async (before = null) => {
+        try {
+            const params = before === null ? {} : { before };
+            const response = await axios.get(`${API_URL}/search-history`, { params });
+            setHistory((previous) => (before === null ? response.data : [...previous, ...response.data]));
+            setNextCursor(response.headers['x-next-cursor'] ?? null);
+        } catch (error) {
+            console.error('Error fetching search history:', error);
+        }
+    }, []);
 
+    useEffect(() => {
         fetchHistory();
-    }, []);
+    }, [fetchHistory]);
 
     const enterSession = (sessionId) => {
         navigate(`/stream/${sessionId}`);
@@ -40,6 +44,9 @@ const SearchHistory = () => {
                     ))}
                 </ul>
             )}
+            {nextCursor !== null && (
+                <button onClick={() => fetchHistory(nextCursor)}>Load More</button>
+            )}
             <button onClick={() => navigate('/')}>Start New Session</button>
         </div>
     );
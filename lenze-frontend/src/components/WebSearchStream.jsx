@@ -33,13 +33,20 @@ const WebSearchStream = () => {
     const fetchPreviousConversations = useCallback(async () => {
         if (!sessionId) return;
         try {
-            const response = await fetch(`${API_URL}/conversations/${sessionId}`);
-            if (response.ok) {
-                const data = await response.json();
-                setPreviousConversations(data);
-            } else {
-                console.error('Failed to fetch previous conversations');
-            }
+            // Conversations are paged oldest first, follow the cursor until the last page
+            const conversations = [];
+            let after = null;
+            do {
+                const url = `${API_URL}/conversations/${sessionId}` + (after === null ? '' : `?after=${after}`);
+                const response = await fetch(url);
+                if (!response.ok) {
+                    console.error('Failed to fetch previous conversations');
+                    return;
+                }
+                conversations.push(...(await response.json()));
+                after = response.headers.get('X-Next-Cursor');
+            } while (after !== null);
+            setPreviousConversations(conversations);
         } catch (error) {
             console.error('Error fetching previous conversations:', error);
         }